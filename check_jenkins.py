@@ -5,9 +5,21 @@
 # Check Jenkins Jobs Nagios Plugin
 #
 
-import argparse, sys
+import argparse, sys, os, re, json, tempfile, threading, time, heapq
 import jenkins
+import requests
+from nagios_threshold import Threshold, ThresholdError
+from collections import OrderedDict, deque
 from datetime import datetime
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import quote, urlparse
+except ImportError:
+    from urllib import quote
+    from urlparse import urlparse
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Nagios return codes
@@ -16,6 +28,7 @@ STATE_OK = 0
 STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
 exit_satus = STATE_OK
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -42,6 +55,70 @@ def printVerbose(str):
     if args.verbose_mode:
         print(str)
 
+class CheckError(Exception):
+    # Error of a check, the message is the UNKNOWN output of the plugin
+    pass
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Response cache
+#
+class ResponseCache(object):
+    # Cache kept between runs of the finished builds, that never change, and of
+    # the job info with its ETag/Last-Modified to revalidate it. The least
+    # recently used entries are dropped when there are more than size entries.
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.entries = OrderedDict()
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.size <= 0:
+            return
+        try:
+            with open(self.path) as cache_file:
+                self.entries = OrderedDict(json.load(cache_file, object_pairs_hook=OrderedDict))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        except (IOError, OSError, ValueError):
+            printVerbose("CACHE: " + self.path + " not loaded")
+            self.entries = OrderedDict()
+
+    def save(self):
+        if self.size <= 0 or not self.changed:
+            return
+        temp_path = self.path + "." + str(os.getpid())
+        with self.lock:
+            data = json.dumps(self.entries)
+        try:
+            with open(temp_path, 'w') as cache_file:
+                cache_file.write(data)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            printVerbose("CACHE: " + self.path + " not saved")
+            printVerbose(sys.exc_info())
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            # The order of use is only saved with the next change, a run
+            # that only reads the cache does not rewrite it
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            self.changed = True
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Parse arguments
 #
@@ -59,12 +136,53 @@ conn_parameters.add_argument('-H', '--host',
 group = conn_parameters.add_mutually_exclusive_group()
 group.add_argument('-J', '--job', help='Job name')
 group.add_argument('-V', '--view', help='View name')
+group.add_argument('-Q', '--queue', help='Check the build queue and the executors of the nodes', action="store_true")
+group.add_argument('-F', '--folder', help='Folder name (folder/subfolder), all its jobs and subfolders are checked. Use / for all the jobs of Jenkins')
 conn_parameters.add_argument('-u', '--user',
     help='Username',
     required=False)
 conn_parameters.add_argument('-p', '--password',
     help='Password',
     required=False)
+conn_parameters.add_argument('--fetch',
+    help='How the jobs of a view are requested: all the view in one request (tree) or each job by separate (jobs)',
+    choices=['tree', 'jobs'],
+    default='tree')
+conn_parameters.add_argument('--job-perfdata', action="store_true",
+    help='Add the performance data of each job of a view (4 values by job), by default only the totals and percentiles of the view. A large view can exceed the 8KB output of a Nagios plugin')
+conn_parameters.add_argument('--workers',
+    help='Number of jobs of a view evaluated at the same time with --fetch jobs',
+    type=int,
+    default=10)
+conn_parameters.add_argument('--deadline',
+    help='Value, in seconds, to evaluate the jobs of a view. Jobs not evaluated in time are UNKNOWN',
+    type=int,
+    default=50)
+conn_parameters.add_argument('--folder-depth',
+    help='Levels of subfolders requested at once with --folder',
+    type=int,
+    default=3)
+conn_parameters.add_argument('--worst',
+    help='Number of worst jobs shown in the summary of --folder',
+    type=int,
+    default=5)
+conn_parameters.add_argument('--cache-file',
+    help='File of the cache of finished builds and job info kept between runs. Default: check_jenkins_<host>.json in the temporary directory')
+conn_parameters.add_argument('--cache-size',
+    help='Number of builds and jobs kept in the cache, 0 to disable it',
+    type=int,
+    default=5000)
+passive_parameters = parser.add_argument_group('Passive check parameters', 'Send the result of each job of --folder as a passive check result')
+passive_parameters.add_argument('--passive',
+    help='Send a passive check result by job of the folder, the summary is the active check result',
+    action="store_true")
+passive_parameters.add_argument('--passive-host',
+    help='Nagios host name of the passive results. Default: host of the Jenkins URL')
+passive_parameters.add_argument('--passive-service',
+    help='Nagios service description of the passive results, %%(job)s is the job name. Default: Jenkins %%(job)s',
+    default='Jenkins %(job)s')
+passive_parameters.add_argument('--command-file',
+    help='Nagios external command file (/usr/local/nagios/var/rw/nagios.cmd). Without it the passive results are printed')
 threshlod_parameters = parser.add_argument_group('Threshold parameters', 'Thresholds values for warning and critical')
 threshlod_parameters.add_argument('--warn-running',
     help='Value, in seconds, for the warning threshold of a running job',
@@ -85,6 +203,18 @@ threshlod_parameters.add_argument('--crit-last-run',
 threshlod_parameters.add_argument("--error-on-disabled", help="Return CRITICAL if a job is disabled", action="store_true")
 threshlod_parameters.add_argument("--error-on-notbuilt", help="Return CRITICAL if a job has not been built", action="store_true")
 threshlod_parameters.add_argument("--ignore-period", help="Do not check the period of a job execution", action="store_true")
+threshlod_parameters.add_argument('--warn-queue-wait',
+    help='Range, in seconds, for the warning threshold of the oldest item of the build queue. Default: 300',
+    default="300")
+threshlod_parameters.add_argument('--crit-queue-wait',
+    help='Range, in seconds, for the critical threshold of the oldest item of the build queue. Default: 900',
+    default="900")
+threshlod_parameters.add_argument('--warn-utilization',
+    help='Range, in percent, for the warning threshold of the busy executors of all the nodes and of each label. Default: 80',
+    default="80")
+threshlod_parameters.add_argument('--crit-utilization',
+    help='Range, in percent, for the critical threshold of the busy executors of all the nodes and of each label. Default: 95',
+    default="95")
 # Parse arguments:
 args = parser.parse_args()
 # Assign variables:
@@ -94,6 +224,8 @@ if args.job:
     printVerbose("Job: " + args.job)
 if args.view:
     printVerbose("View: " + args.view)
+if args.folder:
+    printVerbose("Folder: " + args.folder)
 if args.user:
     printVerbose("USER: " + args.user)
 if args.password:
@@ -102,6 +234,26 @@ printVerbose("WARN RUNNING: " + str(args.warn_running))
 printVerbose("CRIT RUNNING: " + str(args.crit_running))
 printVerbose("WARN LAST RUN: " + str(args.warn_last_run))
 printVerbose("CRIT LAST RUN: " + str(args.crit_last_run))
+if args.queue:
+    printVerbose("WARN QUEUE WAIT: " + str(args.warn_queue_wait))
+    printVerbose("CRIT QUEUE WAIT: " + str(args.crit_queue_wait))
+    printVerbose("WARN UTILIZATION: " + str(args.warn_utilization))
+    printVerbose("CRIT UTILIZATION: " + str(args.crit_utilization))
+    try:
+        queue_wait_threshold = Threshold(args.warn_queue_wait, args.crit_queue_wait)
+        utilization_threshold = Threshold(args.warn_utilization, args.crit_utilization)
+    except ThresholdError as e:
+        parser.error(str(e))
+if not args.cache_file:
+    args.cache_file = os.path.join(tempfile.gettempdir(), "check_jenkins_" + re.sub(r'[^A-Za-z0-9.-]+', '_', jenkins_server) + ".json")
+printVerbose("CACHE FILE: " + args.cache_file)
+response_cache = ResponseCache(args.cache_file, args.cache_size)
+if args.passive and not args.passive_host:
+    args.passive_host = urlparse(jenkins_server).hostname
+if args.view:
+    printVerbose("FETCH: " + args.fetch)
+    printVerbose("WORKERS: " + str(args.workers))
+    printVerbose("DEADLINE: " + str(args.deadline) + "s")
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Jenkins functions
@@ -114,36 +266,87 @@ def connectJenkins(jenkins_server, user = None, password = None):
             server = jenkins.Jenkins(jenkins_server, timeout=5)
         return server
     except:
-        print("UNKNOWN - Error al intentar conectar con Jenkins")
         printVerbose(sys.exc_info())
-        sys.exit(STATE_UNKNOWN)
+        raise CheckError("UNKNOWN - Error al intentar conectar con Jenkins")
+
+# Job info fields kept in the cache:
+JOB_FIELDS = ['name', 'color', 'url', 'lastBuild', 'lastCompletedBuild', 'lastSuccessfulBuild', 'healthReport']
+# Job info requested, the last successful build comes inside it:
+JOB_INFO_TREE = ("name,color,url,healthReport[score],lastBuild[number],lastCompletedBuild[number]," +
+                 "lastSuccessfulBuild[number,timestamp,duration]")
+# Build info fields kept in the cache:
+BUILD_FIELDS = ['number', 'building', 'timestamp', 'duration', 'estimatedDuration', 'result', 'url']
+
+def jobUrl(server, job_name):
+    # URL of the job info, the job name may have folders: folder/job
+    url = server.server.rstrip('/') + '/'
+    for name in job_name.split('/'):
+        url = url + 'job/' + quote(name) + '/'
+    return url + 'api/json?tree=' + JOB_INFO_TREE
 
 def getJobInfo(server, job_name):
     printVerbose("----------------------------------------------")
     printVerbose("JOB NAME: " + job_name)
+    # Revalidate the cached job info, Jenkins answers 304 if it did not change:
+    cached = response_cache.get("job " + job_name)
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
     try:
-        server.assert_job_exists(name=job_name)
-        job_info = server.get_job_info(name=job_name)
+        response = server.jenkins_request(requests.Request('GET', jobUrl(server, job_name), headers=headers))
+        if response.status_code == 304:
+            printVerbose("CACHE: job info not modified")
+            job_info = cached['info']
+        else:
+            job_info = response.json()
+            if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+                response_cache.put("job " + job_name, {'etag': response.headers.get('ETag'),
+                                                       'last_modified': response.headers.get('Last-Modified'),
+                                                       'info': dict([(field, job_info.get(field)) for field in JOB_FIELDS])})
     except:
-        print("UNKNOWN - Error al intentar obtener información del job " + job_name)
         printVerbose(sys.exc_info())
-        sys.exit(STATE_UNKNOWN)
+        raise CheckError("UNKNOWN - Error al intentar obtener información del job " + job_name)
+    printJobInfo(job_info)
+    return job_info
+
+def printJobInfo(job_info):
     printVerbose("COLOR: " + job_info['color'])
     if (job_info['color'].find('disabled') == -1):
-        printVerbose("LAST BUILD: " + str(job_info['lastBuild']['number']))
-        printVerbose("LAST COMPLETED BUILD: " + str(job_info['lastCompletedBuild']['number']))
-        for report in job_info['healthReport']:
+        if job_info['lastBuild']:
+            printVerbose("LAST BUILD: " + str(job_info['lastBuild']['number']))
+        if job_info['lastCompletedBuild']:
+            printVerbose("LAST COMPLETED BUILD: " + str(job_info['lastCompletedBuild']['number']))
+        for report in job_info.get('healthReport', []):
             printVerbose("HEALTH REPORT: " + str(report['score']))
-    return job_info
+
+# Builds already requested in this run, by job name and build number:
+build_memo = {}
 
 def getBuildInfo(server, job_name, build_number):
     printVerbose(">>> " + job_name + " #" + str(build_number))
-    try:
-        build_info = server.get_build_info(name=job_name, number=build_number)
-    except:
-        print("UNKNOWN - Error al intentar obtener información del build " + build_number)
-        printVerbose(sys.exc_info())
-        sys.exit(STATE_UNKNOWN)
+    if (job_name, build_number) in build_memo:
+        return build_memo[(job_name, build_number)]
+    # A finished build never changes, it is requested only once:
+    build_info = response_cache.get("build " + job_name + " #" + str(build_number))
+    if build_info:
+        printVerbose("CACHE: finished build")
+    else:
+        try:
+            build_info = server.get_build_info(name=job_name, number=build_number)
+        except:
+            printVerbose(sys.exc_info())
+            raise CheckError("UNKNOWN - Error al intentar obtener información del build " + job_name + " #" + str(build_number))
+        if not build_info['building']:
+            cached = dict([(field, build_info.get(field)) for field in BUILD_FIELDS])
+            cached['actions'] = [action for action in build_info.get('actions', []) if action and 'queuingDurationMillis' in action]
+            response_cache.put("build " + job_name + " #" + str(build_number), cached)
+    build_memo[(job_name, build_number)] = build_info
+    printBuildInfo(build_info)
+    return build_info
+
+def printBuildInfo(build_info):
     printVerbose("BUILD #" + str(build_info['number']))
     printVerbose("IS RUNNING: " + str(build_info['building']))
     printVerbose("DURATION: " + str(int(build_info['duration'] / 1000)) + "s")
@@ -152,12 +355,16 @@ def getBuildInfo(server, job_name, build_number):
         printVerbose("RESULT: " + build_info['result'])
     printVerbose("TIMESTAMP: " + str(build_info['timestamp']))
     printVerbose("TEMESTAMP ISO: " + datetime.fromtimestamp(build_info['timestamp'] / 1000).isoformat())
-    return build_info
 
 def checkJobStatus(server, job_name):
-    job_result = {'status': STATE_OK, 'text': "OK - Job " + job_name + " is SUCCESSFUL", 'duration': "0s"}
-    # Get job info:
+    # Get job info, the builds are requested only if they are needed:
     job_info = getJobInfo(server, job_name)
+    return evaluateJob(job_name, job_info, lambda build_number: getBuildInfo(server, job_name, build_number))
+
+def evaluateJob(job_name, job_info, getBuild):
+    # Result of a job from its info, getBuild(build_number) returns the info of
+    # the lastBuild or lastCompletedBuild of the job
+    job_result = {'status': STATE_OK, 'text': "OK - Job " + job_name + " is SUCCESSFUL", 'duration': "0s"}
     # Check if it is disabled or if it has no builds:
     if (job_info['color'].find('disabled') != -1):
         job_result = {'status': STATE_OK, 'text': "OK - Job " + job_name + " is disabled. Please check: " + job_info['url'], 'duration': "0s"}
@@ -169,7 +376,7 @@ def checkJobStatus(server, job_name):
             job_result = {'status': STATE_CRITICAL, 'text': "CRITICAL - Job " + job_name + " has NOT BEEN BUILT. Please check: " + job_info['url'], 'duration': "0s"}
     else:
         # Get build info of current process:
-        build_info = getBuildInfo(server, job_name, job_info['lastBuild']['number'])
+        build_info = getBuild(job_info['lastBuild']['number'])
         # Get estimated duration in seconds:
         estimated_duration = int(build_info['estimatedDuration'] / 1000)
         # Get elapsed time:
@@ -187,7 +394,7 @@ def checkJobStatus(server, job_name):
                 job_result = {'status': STATE_WARNING, 'text': "WARNING - Job " + job_name + " is taking 50% more time than espected: " + str(elapsed_time) + " seconds. Please check: " + job_info['url'], 'duration': "0s"}
             else:
                 # Evaluate last completed build:
-                build_info = getBuildInfo(server, job_name, job_info['lastCompletedBuild']['number'])
+                build_info = getBuild(job_info['lastCompletedBuild']['number'])
                 if build_info['result'] != 'SUCCESS':
                     job_result = {'status': STATE_CRITICAL, 'text': "CRITICAL - Job " + job_name + " completed with errors. Please check: " + job_info['url'], 'duration': (str(int(build_info['duration'] / 1000)) + "s")}
                 else:
@@ -211,27 +418,316 @@ def checkJobStatus(server, job_name):
                     job_result = {'status': STATE_WARNING, 'text': "WARNING - Job " + job_name + " has not been completed in the normal period. Please check: " + job_info['url'], 'duration': (str(int(build_info['duration'] / 1000)) + "s")}
                 else:
                     job_result = {'status': STATE_OK, 'text': "OK - Job " + job_name + " is SUCCESSFUL. Please check: " + job_info['url'], 'duration': (str(int(build_info['duration'] / 1000)) + "s")}
+        job_result['metrics'] = jobMetrics(job_info, getBuild)
     return job_result
 
-def checkViewStatus(server, view_name):
-    view_result = {'status': STATE_OK, 'text': "OK - All jobs in view " + view_name + " are ok", 'duration': "0s"}
-    printVerbose("==============================================")
-    printVerbose("VIEW: " + view_name)
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Performance data
+#
+def queueWait(build_info):
+    # Seconds the build waited in the queue (TimeInQueueAction of the metrics
+    # plugin), None if it is unknown
+    for action in build_info.get('actions') or []:
+        if action and 'queuingDurationMillis' in action:
+            return action['queuingDurationMillis'] / 1000.0
+    return None
+
+def jobMetrics(job_info, getBuild):
+    # Performance values of a job with builds, in seconds
+    now = time.time()
+    last_build = getBuild(job_info['lastBuild']['number'])
+    metrics = {'estimated': last_build['estimatedDuration'] / 1000.0, 'running': last_build['building'],
+               'queue': queueWait(last_build)}
+    if last_build['building']:
+        elapsed = now - last_build['timestamp'] / 1000.0
+    else:
+        elapsed = last_build['duration'] / 1000.0
+    metrics['over_estimate'] = metrics['estimated'] > 0 and elapsed > metrics['estimated']
+    if job_info.get('lastCompletedBuild'):
+        metrics['duration'] = getBuild(job_info['lastCompletedBuild']['number'])['duration'] / 1000.0
+    if job_info.get('lastSuccessfulBuild'):
+        success = job_info['lastSuccessfulBuild']
+        if 'timestamp' not in success:
+            success = getBuild(success['number'])
+        metrics['since_success'] = now - (success['timestamp'] + success['duration']) / 1000.0
+    return metrics
+
+def jobPerfdata(metrics, label=None):
+    # Performance data of a job; with a label (the job name in a view) each
+    # value is named 'label value', without it the duration is left out as
+    # it is already the duration= value of the job
+    perfdata = []
+    for name, key in [("duration", 'duration'), ("estimated", 'estimated'), ("since success", 'since_success'), ("queue", 'queue')]:
+        if metrics.get(key) is None or (key == 'duration' and not label):
+            continue
+        if label:
+            name = "'" + label + " " + name + "'"
+        else:
+            name = name.replace(" ", "_")
+        perfdata.append(name + "=" + str(int(round(metrics[key]))) + "s;;;0")
+    return " ".join(perfdata)
+
+def percentile(values, percent):
+    # Nearest rank percentile of a sorted list
+    if not values:
+        return 0
+    rank = int(len(values) * percent / 100.0 + 0.999999)
+    return values[max(0, min(rank, len(values)) - 1)]
+
+class JobStatistics(object):
+    # Aggregate performance values of the jobs of a view or folder, the jobs
+    # are added one by one as they are evaluated
+    def __init__(self):
+        self.durations = []
+        self.running = 0
+        self.over_estimate = 0
+
+    def add(self, metrics):
+        if metrics.get('duration') is not None:
+            self.durations.append(metrics['duration'])
+        if metrics.get('running'):
+            self.running = self.running + 1
+        if metrics.get('over_estimate'):
+            self.over_estimate = self.over_estimate + 1
+
+    def perfdata(self):
+        self.durations.sort()
+        return ("duration_p50=" + str(int(round(percentile(self.durations, 50)))) + "s;;;0" +
+                " duration_p95=" + str(int(round(percentile(self.durations, 95)))) + "s;;;0" +
+                " running=" + str(self.running) + ";;;0" +
+                " over_estimate=" + str(self.over_estimate) + ";;;0")
+
+def checkJobsStatus(server, job_names):
+    # Evaluate the jobs with a pool of workers, in the same order as job_names.
+    # Jobs with errors, or not evaluated before the deadline, are UNKNOWN.
+    deadline = time.time() + args.deadline
+    pending = queue.Queue()
+    for job_name in job_names:
+        pending.put(job_name)
+    results = {}
+    def worker():
+        while time.time() < deadline:
+            try:
+                job_name = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[job_name] = checkJobStatus(server, job_name)
+            except CheckError as e:
+                results[job_name] = {'status': STATE_UNKNOWN, 'text': str(e), 'duration': "0s"}
+            except Exception:
+                printVerbose(sys.exc_info())
+                results[job_name] = {'status': STATE_UNKNOWN, 'text': "UNKNOWN - Error al evaluar el job " + job_name, 'duration': "0s"}
+    workers = []
+    for i in range(max(1, min(args.workers, len(job_names)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join(max(0, deadline - time.time()))
+    # Jobs still running after the deadline are left to the daemon threads:
+    results = dict(results)
+    job_results = []
+    for job_name in job_names:
+        if job_name in results:
+            job_results.append(results[job_name])
+        else:
+            job_results.append({'status': STATE_UNKNOWN, 'text': "UNKNOWN - Job " + job_name + " was not evaluated in " + str(args.deadline) + " seconds", 'duration': "0s"})
+    return job_results
+
+# Fields of the jobs of a view used by evaluateJob(), requested all at once:
+BUILD_TREE = "number,building,timestamp,duration,estimatedDuration,result"
+JOB_TREE = ("name,color,url,lastBuild[" + BUILD_TREE + ",actions[queuingDurationMillis]],lastCompletedBuild[" + BUILD_TREE + "]," +
+            "lastSuccessfulBuild[" + BUILD_TREE + "]")
+VIEW_TREE = "?tree=jobs[" + JOB_TREE + "]"
+
+def evaluateTreeJob(job_name, job_info):
+    # Evaluate a job from a tree query, with its builds inside the job info
+    printVerbose("----------------------------------------------")
+    printVerbose("JOB NAME: " + job_name)
+    builds = {}
+    for build_info in [job_info.get('lastSuccessfulBuild'), job_info.get('lastCompletedBuild'), job_info.get('lastBuild')]:
+        if build_info:
+            builds[build_info['number']] = build_info
+    def getBuild(build_number):
+        printVerbose(">>> " + job_name + " #" + str(build_number))
+        printBuildInfo(builds[build_number])
+        return builds[build_number]
+    try:
+        printJobInfo(job_info)
+        return evaluateJob(job_name, job_info, getBuild)
+    except Exception:
+        printVerbose(sys.exc_info())
+        return {'status': STATE_UNKNOWN, 'text': "UNKNOWN - Error al evaluar el job " + job_name, 'duration': "0s"}
+
+def checkViewTree(server, view_name):
+    # Evaluate the jobs of a view with a single request
+    try:
+        view_info = server.get_info(item="view/" + view_name, query=VIEW_TREE)
+    except:
+        printVerbose(sys.exc_info())
+        raise CheckError("UNKNOWN - Error al intentar obtener información de la vista " + view_name)
+    job_results = []
+    for job_info in view_info['jobs']:
+        job_results.append((job_info['name'], evaluateTreeJob(job_info['name'], job_info)))
+    return job_results
+
+def folderTree(depth):
+    # Tree query of the jobs of a folder and its subfolders up to depth levels.
+    # The folders of the last level have only the names of their jobs, they
+    # are requested later.
+    if depth <= 1:
+        return "jobs[" + JOB_TREE + ",jobs[name]]"
+    return "jobs[" + JOB_TREE + "," + folderTree(depth - 1) + "]"
+
+def folderItem(folder_name):
+    # Jenkins item of a folder: folder/subfolder -> job/folder/job/subfolder
+    item = ""
+    for name in folder_name.strip('/').split('/'):
+        if name:
+            item = item + "/job/" + name
+    return item.lstrip('/')
+
+def walkFolder(server, folder_name, deadline):
+    # Generator of the jobs of a folder and its subfolders: (job name, job
+    # info, None), or (folder name, None, error text) for a folder that can't
+    # be read. Each request reads --folder-depth levels of the tree, and the
+    # jobs are returned as soon as their subtree is read.
+    query = "?tree=" + folderTree(args.folder_depth)
+    root_name = folder_name.strip('/')
+    pending = deque([root_name])
+    while pending:
+        folder_name = pending.popleft()
+        if time.time() > deadline and folder_name != root_name:
+            yield folder_name, None, "UNKNOWN - Folder " + folder_name + " was not checked in " + str(args.deadline) + " seconds"
+            continue
+        printVerbose("==============================================")
+        printVerbose("FOLDER: " + folder_name)
+        try:
+            folder_info = server.get_info(item=folderItem(folder_name), query=query)
+        except:
+            printVerbose(sys.exc_info())
+            if folder_name == root_name:
+                raise CheckError("UNKNOWN - Error al intentar obtener información de la carpeta " + folder_name)
+            yield folder_name, None, "UNKNOWN - Error al intentar obtener información de la carpeta " + folder_name
+            continue
+        subtrees = [(folder_name, folder_info.get('jobs', []), 1)]
+        while subtrees:
+            parent, items, level = subtrees.pop()
+            for item in items:
+                job_name = item['name']
+                if parent:
+                    job_name = parent + "/" + item['name']
+                if 'jobs' not in item:
+                    yield job_name, item, None
+                elif level < args.folder_depth:
+                    subtrees.append((job_name, item['jobs'], level + 1))
+                else:
+                    pending.append(job_name)
+
+def checkFolderStatus(server, folder_name):
+    # Evaluate every job of a folder tree as it is read. Each job result is
+    # sent as a passive result with --passive, and the summary (jobs by state
+    # and the worst jobs) is the result of the check. Without --command-file
+    # the passive results are printed after the summary, as nagios takes the
+    # first line as the output of the check.
+    deadline = time.time() + args.deadline
+    count = [0, 0, 0, 0]
+    statistics = JobStatistics()
+    worst = []
+    sum_duration = 0
+    command_file = None
+    passive_lines = []
+    if args.passive and args.command_file:
+        try:
+            command_file = open(args.command_file, 'a')
+        except (IOError, OSError):
+            printVerbose(sys.exc_info())
+            raise CheckError("UNKNOWN - Error al intentar abrir el archivo de comandos " + args.command_file)
+    try:
+        sequence = 0
+        for job_name, job_info, error_text in walkFolder(server, folder_name, deadline):
+            if job_info is None:
+                job_result = {'status': STATE_UNKNOWN, 'text': error_text, 'duration': "0s"}
+            else:
+                job_result = evaluateTreeJob(job_name, job_info)
+            printVerbose("JOB STATUS: " + str(job_result['status']))
+            printVerbose("TEXT: " + job_result['text'])
+            count[job_result['status']] = count[job_result['status']] + 1
+            if 'metrics' in job_result:
+                statistics.add(job_result['metrics'])
+            sum_duration = sum_duration + int(job_result['duration'][0:-1])
+            if job_result['status'] != STATE_OK:
+                # Keep the worst jobs, the first ones found for the same state:
+                sequence = sequence + 1
+                entry = (job_result['status'], -sequence, job_name)
+                if len(worst) < args.worst:
+                    heapq.heappush(worst, entry)
+                elif worst and entry > worst[0]:
+                    heapq.heapreplace(worst, entry)
+            if args.passive:
+                perfdata = "duration=" + job_result['duration']
+                if 'metrics' in job_result:
+                    perfdata = perfdata + " " + jobPerfdata(job_result['metrics'])
+                line = "[%i] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%i;%s|%s\n" % (int(time.time()), args.passive_host,
+                    args.passive_service % {'job': job_name}, job_result['status'], job_result['text'], perfdata)
+                if command_file:
+                    command_file.write(line)
+                    command_file.flush()
+                else:
+                    passive_lines.append(line)
+    finally:
+        if command_file:
+            command_file.close()
+    folder_status = STATE_OK
+    for state in [STATE_WARNING, STATE_CRITICAL, STATE_UNKNOWN]:
+        if count[state]:
+            folder_status = state
+    text = STATE_NAMES[folder_status] + " - Folder " + folder_name + ": " + str(sum(count)) + " jobs"
+    for state in [STATE_OK, STATE_WARNING, STATE_CRITICAL, STATE_UNKNOWN]:
+        text = text + ", " + str(count[state]) + " " + STATE_NAMES[state]
+    if worst:
+        worst.sort(reverse=True)
+        text = text + ". Worst: " + ", ".join([job_name + " " + STATE_NAMES[state] for state, sequence, job_name in worst])
+    text = text + ". Server: " + jenkins_server
+    perfdata = "jobs=" + str(sum(count))
+    for state in [STATE_OK, STATE_WARNING, STATE_CRITICAL, STATE_UNKNOWN]:
+        perfdata = perfdata + " " + STATE_NAMES[state].lower() + "=" + str(count[state])
+    perfdata = perfdata + " " + statistics.perfdata()
+    return {'status': folder_status, 'text': text, 'duration': str(sum_duration) + "s", 'perfdata': perfdata, 'passive': "".join(passive_lines)}
+
+def checkViewJobs(server, view_name):
+    # Evaluate the jobs of a view requesting each job and its builds
     try:
-        server.assert_view_exists(name=view_name)
         job_list = server.get_jobs(view_name=view_name)
     except:
-        print("UNKNOWN - Error al intentar obtener información de la vista " + view_name)
         printVerbose(sys.exc_info())
-        sys.exit(STATE_UNKNOWN)
+        raise CheckError("UNKNOWN - Error al intentar obtener información de la vista " + view_name)
+    job_names = [job['name'] for job in job_list]
+    return list(zip(job_names, checkJobsStatus(server, job_names)))
+
+def checkViewStatus(server, view_name):
+    view_result = {'status': STATE_OK, 'text': "OK - All jobs in view " + view_name + " are ok", 'duration': "0s"}
+    printVerbose("==============================================")
+    printVerbose("VIEW: " + view_name)
+    if args.fetch == 'tree':
+        job_results = checkViewTree(server, view_name)
+    else:
+        job_results = checkViewJobs(server, view_name)
     # Check each job of the view:
     max_job_error = STATE_OK
     sum_duration = 0
-    for job in job_list:
-        job_result = checkJobStatus(server, job['name'])
+    statistics = JobStatistics()
+    perfdata = []
+    for job_name, job_result in job_results:
         printVerbose("JOB STATUS: " + str(job_result['status']))
         printVerbose("TEXT: " + job_result['text'])
         sum_duration = sum_duration + int(job_result['duration'][0:-1])
+        if 'metrics' in job_result:
+            statistics.add(job_result['metrics'])
+            if args.job_perfdata:
+                perfdata.append(jobPerfdata(job_result['metrics'], job_name))
         if (job_result['status'] != STATE_OK):
             if (job_result['status'] > max_job_error):
                 view_result = job_result
@@ -241,20 +737,126 @@ def checkViewStatus(server, view_name):
     if (max_job_error == STATE_OK):
         view_result['duration'] = str(sum_duration) + "s"
         view_result['text'] = view_result['text'] + ". Server: " + jenkins_server
+    view_result['perfdata'] = " ".join([statistics.perfdata()] + perfdata)
     return view_result
 
+# Fields of the nodes used by checkQueueStatus():
+COMPUTER_TREE = "?tree=computer[displayName,offline,numExecutors,assignedLabels[name],executors[idle]]"
+
+def checkQueueStatus(server):
+    # Build queue length and wait, and busy executors of the online nodes by
+    # label, in two requests
+    printVerbose("==============================================")
+    printVerbose("QUEUE")
+    try:
+        queue_items = server.get_queue_info()
+    except:
+        printVerbose(sys.exc_info())
+        raise CheckError("UNKNOWN - Error al intentar obtener información de la cola de builds")
+    try:
+        computers = server.get_info(item="computer", query=COMPUTER_TREE)['computer']
+    except:
+        printVerbose(sys.exc_info())
+        raise CheckError("UNKNOWN - Error al intentar obtener información de los nodos")
+    now = time.time()
+    # Oldest item of the queue:
+    oldest_wait = 0
+    oldest_name = None
+    for item in queue_items:
+        wait = now - item['inQueueSince'] / 1000.0
+        printVerbose("QUEUED: " + item.get('task', {}).get('name', str(item.get('id'))) + " " + str(int(wait)) + "s " + str(item.get('why')))
+        if wait > oldest_wait:
+            oldest_wait = wait
+            oldest_name = item.get('task', {}).get('name')
+    # Busy executors by node and by label, only of the online nodes:
+    busy = 0
+    total = 0
+    labels = {}
+    offline = []
+    node_perfdata = []
+    for computer in computers:
+        name = computer['displayName']
+        if computer['offline']:
+            printVerbose("NODE: " + name + " offline")
+            offline.append(name)
+            continue
+        node_total = len(computer.get('executors') or []) or computer.get('numExecutors', 0)
+        node_busy = len([executor for executor in computer.get('executors') or [] if not executor['idle']])
+        printVerbose("NODE: " + name + " " + str(node_busy) + "/" + str(node_total) + " busy")
+        busy = busy + node_busy
+        total = total + node_total
+        node_perfdata.append("'node " + name + " busy'=" + str(node_busy) + ";;;0;" + str(node_total))
+        for label in computer.get('assignedLabels') or []:
+            # The label with the name of the node is already in the node values:
+            if label['name'] == name:
+                continue
+            label_busy, label_total = labels.get(label['name'], (0, 0))
+            labels[label['name']] = (label_busy + node_busy, label_total + node_total)
+    utilization = 0
+    if total:
+        utilization = 100.0 * busy / total
+    # States of the queue wait, of all the executors and of each label:
+    queue_status = queue_wait_threshold.status(oldest_wait)
+    queue_result = {'status': queue_status, 'text': "Queue: " + str(len(queue_items)) + " items"}
+    if oldest_name:
+        queue_result['text'] = queue_result['text'] + ", oldest " + oldest_name + " waiting " + str(int(oldest_wait)) + "s"
+    results = [queue_result]
+    results.append({'status': utilization_threshold.status(utilization),
+                    'text': "Executors: " + str(busy) + "/" + str(total) + " busy (" + str(int(round(utilization))) + "%)"})
+    perfdata = ["queue=" + str(len(queue_items)) + ";;;0",
+                "queue_wait=" + str(int(oldest_wait)) + "s;" + queue_wait_threshold.perfdata() + ";0",
+                "executors=" + str(total) + ";;;0",
+                "busy=" + str(busy) + ";;;0;" + str(total),
+                "utilization=" + str(int(round(utilization))) + "%;" + utilization_threshold.perfdata() + ";0;100",
+                "offline=" + str(len(offline)) + ";;;0"]
+    for label in sorted(labels.keys()):
+        label_busy, label_total = labels[label]
+        if not label_total:
+            continue
+        label_utilization = 100.0 * label_busy / label_total
+        label_status = utilization_threshold.status(label_utilization)
+        if label_status != STATE_OK:
+            results.append({'status': label_status, 'text': "Label " + label + ": " + str(label_busy) + "/" + str(label_total) + " busy (" + str(int(round(label_utilization))) + "%)"})
+        perfdata.append("'label " + label + " utilization'=" + str(int(round(label_utilization))) + "%;" + utilization_threshold.perfdata() + ";0;100")
+    if offline:
+        results.append({'status': STATE_OK, 'text': "Offline nodes: " + ", ".join(offline)})
+    queue_status = max([result['status'] for result in results])
+    text = STATE_NAMES[queue_status] + " - " + ". ".join([result['text'] for result in results]) + ". Server: " + jenkins_server
+    return {'status': queue_status, 'text': text, 'perfdata': " ".join(perfdata + node_perfdata)}
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Perform checks
 #
-if args.user and args.password:
-    server = connectJenkins(jenkins_server, args.user, args.password)
-else:
-    server = connectJenkins(jenkins_server)
-if args.job:
-    result = checkJobStatus(server, args.job)
-elif args.view:
-    result = checkViewStatus(server, args.view)
-print(result['text'] + "|duration=" + str(result['duration']))
+response_cache.load()
+try:
+    if args.user and args.password:
+        server = connectJenkins(jenkins_server, args.user, args.password)
+    else:
+        server = connectJenkins(jenkins_server)
+    if args.job:
+        result = checkJobStatus(server, args.job)
+        if 'metrics' in result:
+            result['perfdata'] = jobPerfdata(result['metrics'])
+    elif args.view:
+        result = checkViewStatus(server, args.view)
+    elif args.folder:
+        result = checkFolderStatus(server, args.folder)
+    elif args.queue:
+        result = checkQueueStatus(server)
+except CheckError as e:
+    print(str(e))
+    sys.exit(STATE_UNKNOWN)
+finally:
+    response_cache.save()
+perfdata = []
+if 'duration' in result:
+    perfdata.append("duration=" + str(result['duration']))
+if 'perfdata' in result:
+    perfdata.append(result['perfdata'])
+perfdata = " ".join(perfdata)
+print(result['text'] + "|" + perfdata)
+if result.get('passive'):
+    sys.stdout.write(result['passive'])
 sys.exit(result['status'])
 
 
@@ -5,9 +5,23 @@
 # Check Monit REST Nagios Plugin
 #
 
-import argparse, sys
+import argparse, sys, re, threading, time
 import requests
 import json
+from decimal import Decimal
+from nagios_threshold import Threshold, ThresholdError
+# Errors of an invalid or truncated document, while it is parsed or read:
+PARSE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IOError, requests.packages.urllib3.exceptions.HTTPError)
+try:
+    import ijson
+    from ijson.common import ObjectBuilder
+    PARSE_ERRORS = PARSE_ERRORS + (ijson.JSONError,)
+except ImportError:
+    ijson = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Nagios return codes
@@ -16,7 +30,8 @@ STATE_OK = 0
 STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
-exit_satus = STATE_OK
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+exit_status = STATE_OK
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Plugin info
@@ -52,28 +67,83 @@ parser.add_argument('-v','--version', action='version',
 parser.add_argument("--verbose-mode", help="Increase output verbosity", action="store_true")
 conn_parameters = parser.add_argument_group('Connection parameters', 'Parameters for Jenkins connection')
 conn_parameters.add_argument('-H', '--host',
-    help='Server host. Example: as1.test.promar.b2b',
-    required=True)
+    help='Server host. Example: as1.test.promar.b2b')
 conn_parameters.add_argument('-P', '--port',
     help='M/Monit API REST port. Default: 2813',
     default='2813')
 conn_parameters.add_argument('--uri',
     help='M/Monit API REST uri. Default: /Monit',
     default='/Monit')
+conn_parameters.add_argument('-t', '--timeout',
+    help='Value, in seconds, to connect and to read the answer of each host. Default: 3',
+    type=float,
+    default=3.0)
+threshold_parameters = parser.add_argument_group('Metric parameters', 'Performance data and thresholds of the values of the monitors (cpu, memory, children, space_usage, port_response_time...)')
+threshold_parameters.add_argument('--threshold',
+    help='Warning and critical ranges of a metric of the monitors: METRIC,WARN,CRIT (example: cpu,80,90 or space_usage,,95). Can be repeated',
+    action='append',
+    default=[])
+threshold_parameters.add_argument('--include-type',
+    help='Monitor type with metrics, can be repeated. Default: Process, Filesystem, Remote Host and System',
+    action='append')
+threshold_parameters.add_argument('--exclude-type',
+    help='Monitor type without metrics, can be repeated',
+    action='append',
+    default=[])
+threshold_parameters.add_argument('--include-name',
+    help='Regular expression of the names of the monitors with metrics')
+threshold_parameters.add_argument('--exclude-name',
+    help='Regular expression of the names of the monitors without metrics')
+threshold_parameters.add_argument('--no-perfdata',
+    help='Do not report the metrics of the monitors as performance data, only the thresholds are checked',
+    action="store_true")
+conn_parameters.add_argument('--stream',
+    help='Parse the answer while it is read, without loading the whole document (needs the ijson module). For hosts with thousands of monitors',
+    action="store_true")
+batch_parameters = parser.add_argument_group('Batch parameters', 'Check several hosts at the same time, instead of -H')
+batch_parameters.add_argument('--batch',
+    help='File with a host by line: host [port [uri]], or - for the standard input. A result by host is printed after the summary of all of them')
+batch_parameters.add_argument('--workers',
+    help='Number of hosts checked at the same time. Default: 20',
+    type=int,
+    default=20)
+batch_parameters.add_argument('--passive',
+    help='Send the result of each host as a passive check result instead of printing it',
+    action="store_true")
+batch_parameters.add_argument('--passive-service',
+    help='Nagios service description of the passive results. Default: Monit',
+    default='Monit')
+batch_parameters.add_argument('--command-file',
+    help='Nagios external command file (/usr/local/nagios/var/rw/nagios.cmd). Without it the passive results are printed')
 # Parse arguments:
 args = parser.parse_args()
+if not args.host and not args.batch:
+    parser.error("-H/--host or --batch is required")
+# Thresholds by metric:
+thresholds = {}
+for threshold in args.threshold:
+    fields = threshold.split(',')
+    if len(fields) != 3:
+        parser.error("--threshold must be METRIC,WARN,CRIT: " + threshold)
+    try:
+        thresholds[fields[0]] = Threshold(fields[1] or None, fields[2] or None)
+    except ThresholdError as e:
+        parser.error("--threshold " + threshold + ": " + str(e))
+if not args.include_type:
+    args.include_type = ['Process', 'Filesystem', 'Remote Host', 'System']
+if args.stream and ijson is None:
+    printVerbose("STREAM: ijson module not found, the whole document is loaded")
+    args.stream = False
+include_name = args.include_name and re.compile(args.include_name)
+exclude_name = args.exclude_name and re.compile(args.exclude_name)
 # Assign variables:
-monit_url = 'http://' + args.host + ':' + args.port + args.uri
-printVerbose("API REST URL: " + monit_url)
+if args.host:
+    monit_url = 'http://' + args.host + ':' + args.port + args.uri
+    printVerbose("API REST URL: " + monit_url)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-# Perform checks
+# Monit functions
 #
-
-exit_text = ""
-max_error = 0
-error_monitors = []
-performance = ""
 monitor_types = [
     'Process',
     'File',
@@ -91,45 +161,312 @@ status_ok = [
     'Initializing',
     'Inicializando'
 ]
-try:
-    # Connect to monit API REST and get all data:
-    response = requests.get(monit_url, timeout=3.0)
-except:
-    printVerbose(sys.exc_info())
-    exit_text = "UNKNOWN - Error al intentar conectar con la API REST de Monit"
-    exit_satus = STATE_UNKNOWN
-else:
-    printVerbose(response)
-    if (response.status_code == requests.codes.ok):
-        # Get the data in json format:
-        data = response.json()
-        # Print version:
-        version = data['Version']
-        printVerbose("Version: " + version)
-        for monitor in data.keys():
-            # Monitor could be of different types, check if it is a valid one:
+
+# Fields of the monitors that are not metrics:
+ignored_fields = ['status', 'pid', 'parent pid', 'uid', 'effective uid', 'gid', 'permission', 'uptime']
+# Units of the values, converted to seconds and bytes:
+metric_units = {
+    '%': (1, '%'),
+    's': (1, 's'),
+    'ms': (0.001, 's'),
+    'us': (0.000001, 's'),
+    'B': (1, 'B'),
+    'kB': (1024, 'B'),
+    'KB': (1024, 'B'),
+    'MB': (1024 ** 2, 'B'),
+    'GB': (1024 ** 3, 'B'),
+    'TB': (1024 ** 4, 'B'),
+    'B/s': (1, ''),
+    'kB/s': (1024, ''),
+    'MB/s': (1024 ** 2, ''),
+    '': (1, '')
+}
+metric_pattern = re.compile(r'^\[?\s*(-?[0-9]+(?:\.[0-9]+)?)\s*([A-Za-z%/]*)')
+
+def parseMetric(value):
+    # Number and unit of a value of a monitor: "4.2% [1.3 GB]" -> (4.2, '%'),
+    # "0.8 ms" -> (0.0008, 's'). None if it is not a number
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return float(value), ''
+    if not isinstance(value, (str, type(u''))):
+        return None
+    match = metric_pattern.match(value)
+    if not match:
+        return None
+    unit = match.group(2)
+    if unit.startswith('%'):
+        unit = '%'
+    if unit not in metric_units:
+        return None
+    factor, uom = metric_units[unit]
+    return float(match.group(1)) * factor, uom
+
+def selectedMonitor(monitor, process):
+    # Check if the metrics of a monitor are reported, by type and name
+    if monitor not in args.include_type or monitor in args.exclude_type:
+        return False
+    if include_name and not include_name.search(process):
+        return False
+    if exclude_name and exclude_name.search(process):
+        return False
+    return True
+
+def monitorMetrics(process, details):
+    # Metrics of a monitor: [(metric, value, uom)], the metric is the field
+    # name with _ instead of spaces
+    metrics = []
+    for field, value in details.items():
+        if field in ignored_fields:
+            continue
+        metric = parseMetric(value)
+        if metric:
+            metrics.append((field.replace(' ', '_'), metric[0], metric[1]))
+    metrics.sort()
+    return metrics
+
+def formatValue(value):
+    return ('%f' % value).rstrip('0').rstrip('.')
+
+def documentMonitors(data):
+    # Monitors of a loaded document: (type, name, details)
+    # Print version:
+    version = data['Version']
+    printVerbose("Version: " + version)
+    for monitor in data.keys():
+        # Monitor could be of different types, check if it is a valid one:
+        if monitor in monitor_types:
+            printVerbose("Monitor type: " + monitor)
+            for process, details in data[monitor].items():
+                yield monitor, process, details
+
+def streamMonitors(stream):
+    # Monitors of a document as they are read: (type, name, details). Only the
+    # current monitor is kept, with all its details if its metrics are needed
+    # or else just its status, and the rest of the document is skipped
+    # following the depth of the events.
+    depth = 0
+    monitor = None
+    process = None
+    builder = None
+    details = None
+    for event, value in ijson.basic_parse(stream):
+        if details is not None:
+            if builder is not None:
+                builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                details_depth = details_depth + 1
+            elif event in ('end_map', 'end_array'):
+                details_depth = details_depth - 1
+                if details_depth == 0:
+                    if builder is not None:
+                        details = builder.value
+                    yield monitor, process, details
+                    builder = None
+                    details = None
+            elif builder is None and details_depth == 1:
+                if event == 'map_key':
+                    key = value
+                elif key == 'status':
+                    details['status'] = value
+            continue
+        if event in ('start_map', 'start_array'):
+            if depth == 2 and event == 'start_map' and monitor in monitor_types:
+                details = {}
+                details_depth = 1
+                key = None
+                if selectedMonitor(monitor, process):
+                    builder = ObjectBuilder()
+                    builder.event(event, value)
+                continue
+            depth = depth + 1
+        elif event in ('end_map', 'end_array'):
+            depth = depth - 1
+        elif event == 'map_key' and depth == 1:
+            monitor = value
             if monitor in monitor_types:
                 printVerbose("Monitor type: " + monitor)
-                for process, details in data[monitor].items():
-                    printVerbose("Process: " + process)
-                    # Check if this monitor is not OK
-                    if "status" in details and details['status'] not in status_ok:
-                        max_error = max_error + 1
-                        error_monitors.append(process + " (" + details['status'] + ")")
-                        printVerbose("ERROR: " + process + " (" + details['status'] + ")")
+        elif event == 'map_key' and depth == 2:
+            process = value
+        elif depth == 1 and monitor == 'Version':
+            # Print version:
+            printVerbose("Version: " + str(value))
+
+def checkMonit(session, monit_url):
+    # Check all the monitors of a Monit API REST: (status, text, performance)
+    performance = ""
+    max_error = 0
+    error_monitors = []
+    metrics_status = STATE_OK
+    alert_metrics = []
+    perfdata = []
+    try:
+        # Connect to monit API REST and get all data:
+        response = session.get(monit_url, timeout=args.timeout, stream=args.stream)
+    except:
+        printVerbose(sys.exc_info())
+        return STATE_UNKNOWN, "UNKNOWN - Error al intentar conectar con la API REST de Monit", performance
+    printVerbose(response)
+    if (response.status_code == requests.codes.ok):
+        try:
+            if args.stream:
+                response.raw.decode_content = True
+                monitors = streamMonitors(response.raw)
+            else:
+                # Get the data in json format:
+                monitors = documentMonitors(response.json())
+            for monitor, process, details in monitors:
+                printVerbose("Process: " + process)
+                # Check if this monitor is not OK
+                if "status" in details and details['status'] not in status_ok:
+                    max_error = max_error + 1
+                    error_monitors.append(process + " (" + details['status'] + ")")
+                    printVerbose("ERROR: " + process + " (" + details['status'] + ")")
+                # Metrics of the selected monitors:
+                if not selectedMonitor(monitor, process):
+                    continue
+                for metric, value, uom in monitorMetrics(process, details):
+                    printVerbose("METRIC: " + metric + "=" + formatValue(value) + uom)
+                    threshold = thresholds.get(metric)
+                    if threshold:
+                        status = threshold.status(value)
+                        if status != STATE_OK:
+                            alert_metrics.append(process + " " + metric + "=" + formatValue(value) + uom + " (" + STATE_NAMES[status] + ")")
+                            metrics_status = max(metrics_status, status)
+                    if not args.no_perfdata:
+                        limits = ";;"
+                        if threshold:
+                            limits = threshold.perfdata() + ";"
+                        perfdata.append("'" + process + " " + metric + "'=" + formatValue(value) + uom + ";" + limits)
+        except PARSE_ERRORS:
+            printVerbose(sys.exc_info())
+            return STATE_UNKNOWN, "UNKNOWN - La API REST de Monit respondio un documento invalido o incompleto", performance
+        finally:
+            response.close()
         # Check for errors:
+        texts = []
         if max_error > 0:
-            exit_text = "WARNING - Los siguientes monitores de M/Monit estan en estado de error: " + ', '.join(error_monitors)
-            exit_status = STATE_WARNING
+            texts.append("Los siguientes monitores de M/Monit estan en estado de error: " + ', '.join(error_monitors))
+        if alert_metrics:
+            texts.append("Los siguientes valores de M/Monit superan los umbrales: " + ', '.join(alert_metrics))
+        if texts:
+            exit_status = metrics_status
+            if max_error > 0:
+                exit_status = max(exit_status, STATE_WARNING)
+            exit_text = STATE_NAMES[exit_status] + " - " + ". ".join(texts)
         else:
             exit_text = "OK - Todos los monitores de M/Monit estan en estado OK"
             exit_status = STATE_OK
-        performance = "errors=" + str(max_error)
+        performance = " ".join(["errors=" + str(max_error)] + perfdata)
     else:
         exit_text = "UNKNOWN - El servicio API REST de M/Monit no respondio bien: STATUS CODE " + str(response.status_code)
         exit_status = STATE_UNKNOWN
+    return exit_status, exit_text, performance
+
+def readHosts(batch_file):
+    # Hosts of the batch file: [(host, url)], empty lines and # are ignored
+    if batch_file == '-':
+        lines = sys.stdin.readlines()
+    else:
+        with open(batch_file) as hosts_file:
+            lines = hosts_file.readlines()
+    hosts = []
+    for line in lines:
+        fields = line.split('#')[0].split()
+        if not fields:
+            continue
+        port = args.port
+        uri = args.uri
+        if len(fields) > 1:
+            port = fields[1]
+        if len(fields) > 2:
+            uri = fields[2]
+        hosts.append((fields[0], 'http://' + fields[0] + ':' + port + uri))
+    return hosts
 
-print(exit_text + " | " + performance)
-sys.exit(exit_satus)
+def checkBatch(hosts):
+    # Check the hosts with a pool of workers sharing the connection pool of a
+    # session, a slow host only takes its worker. Return the results by host
+    # in the same order: [(host, status, text, performance)]
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max(len(hosts), 1), pool_maxsize=args.workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    pending = queue.Queue()
+    for index in range(len(hosts)):
+        pending.put(index)
+    results = [None] * len(hosts)
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            host, monit_url = hosts[index]
+            printVerbose("API REST URL: " + monit_url)
+            try:
+                results[index] = (host,) + checkMonit(session, monit_url)
+            except Exception:
+                printVerbose(sys.exc_info())
+                results[index] = (host, STATE_UNKNOWN, "UNKNOWN - Error al leer la respuesta de la API REST de Monit", "")
+    workers = []
+    for i in range(max(1, min(args.workers, len(hosts)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
+    session.close()
+    return results
 
+def sendPassive(results):
+    # Write the result of each host in the Nagios external command file.
+    # Without it the lines are returned, to be printed after the summary
+    # (Nagios takes the first line as the output of the check)
+    timestamp = int(time.time())
+    lines = ""
+    for host, status, text, performance in results:
+        lines = lines + "[%i] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%i;%s|%s\n" % (timestamp, host, args.passive_service, status, text, performance)
+    if args.command_file:
+        with open(args.command_file, 'a') as command_file:
+            command_file.write(lines)
+        return ""
+    return lines
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Perform checks
+#
+if args.host:
+    exit_status, exit_text, performance = checkMonit(requests.Session(), monit_url)
+    print(exit_text + " | " + performance)
+    sys.exit(exit_status)
+
+try:
+    hosts = readHosts(args.batch)
+except (IOError, OSError):
+    printVerbose(sys.exc_info())
+    print("UNKNOWN - Error al leer el archivo de hosts " + args.batch)
+    sys.exit(STATE_UNKNOWN)
+results = checkBatch(hosts)
+count = [0, 0, 0, 0]
+for host, status, text, performance in results:
+    count[status] = count[status] + 1
+    exit_status = max(exit_status, status)
+exit_text = STATE_NAMES[exit_status] + " - " + str(len(results)) + " hosts de M/Monit: " + ", ".join([str(count[state]) + " " + STATE_NAMES[state] for state in range(4)])
+performance = "hosts=" + str(len(results)) + " " + " ".join([STATE_NAMES[state].lower() + "=" + str(count[state]) for state in range(4)])
+if args.passive:
+    try:
+        passive_lines = sendPassive(results)
+    except (IOError, OSError):
+        printVerbose(sys.exc_info())
+        print("UNKNOWN - Error al escribir los resultados pasivos en " + str(args.command_file))
+        sys.exit(STATE_UNKNOWN)
+    print(exit_text + " | " + performance)
+    sys.stdout.write(passive_lines)
+else:
+    print(exit_text + " | " + performance)
+    for host, status, text, performance in results:
+        print(host + ": " + text)
+sys.exit(exit_status)
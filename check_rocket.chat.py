@@ -5,11 +5,15 @@
 # Check Rocket.Chat Statistics
 #
 
-import argparse, sys
+import argparse, sys, os, re, time, calendar, tempfile, numbers
 import json
+import requests
 from requests import sessions
 from pprint import pprint
 from rocketchat_API.rocketchat import RocketChat
+from rocketchat_API.APIExceptions.RocketExceptions import RocketAuthenticationException
+from nagios_state import StateStore
+from nagios_threshold import Threshold, ThresholdError, STATE_NAMES
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Plugin info
@@ -59,17 +63,180 @@ group.add_argument('--user',
     help='Rocket.Chat user to connect')
 group.add_argument('--password',
     help='Rocket.Chat user\'s password')
+group.add_argument('--token-file',
+    help='File of the login token kept between runs, it is used until it expires. Default: check_rocket.chat_<host>_<user>.token in the temporary directory')
+parser.add_argument('--refresh', action="store_true",
+    help='Ask the server to compute the statistics now, instead of reading the last ones it computed')
+parser.add_argument('--state-file',
+    help='File of the statistics of the previous runs, used to compute messages and uploads by minute. Default: check_rocket.chat_<host>.state in the temporary directory')
+parser.add_argument('--threshold',
+    help='Warning and critical ranges of a statistic: FIELD,WARN,CRIT (example: onlineUsers,500,800 or uploadsTotalSizeMiB,,9000). FIELD is any number of the statistics (nested ones as "a.b") or a derived value: onlineRatio (%% of users online), uploadsTotalSizeMiB, messagesRate, uploadsRate (by minute), uploadsSizeRate (MiB by hour) or usersDelta. Can be repeated',
+    action='append',
+    default=[])
 parser.add_argument("--verbose-mode", action="store_true",
     help="Increase output verbosity")
 # Parse arguments:
 args = parser.parse_args()
 printVerbose(args)
+# Thresholds by field:
+thresholds = {}
+for threshold in args.threshold:
+    fields = threshold.split(',')
+    if len(fields) != 3:
+        parser.error("--threshold must be FIELD,WARN,CRIT: " + threshold)
+    try:
+        thresholds[fields[0]] = Threshold(fields[1] or None, fields[2] or None)
+    except ThresholdError as e:
+        parser.error("--threshold " + threshold + ": " + str(e))
+server_name = re.sub(r'[^A-Za-z0-9.-]+', '_', re.sub(r'^https?://', '', args.url))
+if not args.token_file:
+    args.token_file = os.path.join(tempfile.gettempdir(), "check_rocket.chat_" + server_name + "_" + re.sub(r'[^A-Za-z0-9.-]+', '_', args.user or '') + ".token")
+if not args.state_file:
+    args.state_file = os.path.join(tempfile.gettempdir(), "check_rocket.chat_" + server_name + ".state")
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Login token
+#
+# The token of the last login is kept in --token-file, readable only by its
+# owner, and it is used until the server rejects it
+def readToken():
+    try:
+        with open(args.token_file) as token_file:
+            token = json.load(token_file)
+    except (IOError, OSError, ValueError):
+        return None
+    if token.get("url") != args.url or token.get("user") != args.user:
+        return None
+    return token
+
+def saveToken(rocket):
+    token = {"url": args.url, "user": args.user, "authToken": rocket.headers["X-Auth-Token"], "userId": rocket.headers["X-User-Id"]}
+    temp_path = args.token_file + "." + str(os.getpid())
+    try:
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as token_file:
+            json.dump(token, token_file)
+        os.rename(temp_path, args.token_file)
+    except (IOError, OSError):
+        printVerbose("TOKEN: " + args.token_file + " not saved")
+        printVerbose(sys.exc_info())
+
+def getStatistics():
+    refresh = "true" if args.refresh else "false"
+    token = readToken()
+    if token is not None:
+        printVerbose("TOKEN: " + args.token_file)
+        rocket = RocketChat(auth_token=token["authToken"], user_id=token["userId"], server_url=args.url)
+        response = rocket.statistics(refresh=refresh)
+        if response.status_code != 401:
+            return response.json()
+        printVerbose("TOKEN: expired")
+    rocket = RocketChat(args.user, args.password, server_url=args.url)
+    saveToken(rocket)
+    return rocket.statistics(refresh=refresh).json()
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Rates
+#
+# The counters of each run are kept in --state-file with the time the server
+# computed them, and the rates are the change between the last two samples
+RATE_FIELDS = ['totalMessages', 'uploadsTotal', 'uploadsTotalSize', 'totalUsers']
+
+def statisticsTime(stats):
+    # Time the statistics were computed ("2020-01-31T12:00:00.000Z"), or now
+    try:
+        return calendar.timegm(time.strptime(stats['createdAt'][:19], "%Y-%m-%dT%H:%M:%S"))
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+def statisticsRates(stats):
+    # {messagesRate, uploadsRate (by minute), usersDelta}, None without a
+    # previous sample
+    timestamp = statisticsTime(stats)
+    try:
+        with StateStore(args.state_file, max_samples=2) as store:
+            last = store.last('statistics')
+            if last is None or timestamp > last[0]:
+                store.add('statistics', dict([(field, stats[field]) for field in RATE_FIELDS]), timestamp)
+            samples = store.samples('statistics')
+    except (IOError, OSError):
+        printVerbose("STATE: " + args.state_file + " not used")
+        printVerbose(sys.exc_info())
+        return None
+    if len(samples) < 2:
+        return None
+    (first_time, first), (last_time, last) = samples
+    minutes = (last_time - first_time) / 60.0
+    return {
+        'messagesRate': (last['totalMessages'] - first['totalMessages']) / minutes,
+        'uploadsRate': (last['uploadsTotal'] - first['uploadsTotal']) / minutes,
+        'uploadsSizeRate': (last['uploadsTotalSize'] - first['uploadsTotalSize']) / 1024 / 1024 / (minutes / 60),
+        'usersDelta': int(last['totalUsers'] - first['totalUsers'])
+    }
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Thresholds
+#
+RATE_VALUES = ['messagesRate', 'uploadsRate', 'uploadsSizeRate', 'usersDelta']
+# Performance data: (label, field, unit)
+PERFDATA = [('online_users', 'onlineUsers', ''), ('away_users', 'awayUsers', ''), ('total_users', 'totalUsers', ''),
+            ('total_rooms', 'totalRooms', ''), ('total_messages', 'totalMessages', ''), ('total_uploads', 'uploadsTotal', ''),
+            ('total_uploads_size', 'uploadsTotalSizeMiB', 'MiB'), ('messages_per_minute', 'messagesRate', ''),
+            ('uploads_per_minute', 'uploadsRate', ''), ('new_users', 'usersDelta', '')]
+
+def formatValue(value):
+    return ('%.2f' % value).rstrip('0').rstrip('.')
+
+def statisticsValues(stats, rates, prefix=''):
+    # Numbers of the statistics by field, nested fields as "a.b", with the
+    # derived values
+    values = {}
+    for field, value in stats.items():
+        if isinstance(value, dict):
+            values.update(statisticsValues(value, None, prefix + field + '.'))
+        elif isinstance(value, numbers.Number) and not isinstance(value, bool):
+            values[prefix + field] = value
+    if prefix:
+        return values
+    if stats.get('totalUsers'):
+        values['onlineRatio'] = 100.0 * stats['onlineUsers'] / stats['totalUsers']
+    values['uploadsTotalSizeMiB'] = int(stats['uploadsTotalSize'] / 1024 / 1024)
+    if rates is not None:
+        values.update(rates)
+    return values
+
+def checkThresholds(values):
+    # Evaluate all the thresholds: (worst state, ["field=value (STATE)"])
+    status = STATE_OK
+    alerts = []
+    for field in sorted(thresholds.keys()):
+        if field not in values:
+            if field in RATE_VALUES:
+                printVerbose("THRESHOLD: " + field + " without a previous sample")
+                continue
+            status = max(status, STATE_UNKNOWN)
+            alerts.append(field + " (unknown statistic)")
+            continue
+        field_status = thresholds[field].status(values[field])
+        printVerbose("THRESHOLD: " + field + "=" + formatValue(values[field]) + " " + STATE_NAMES[field_status])
+        if field_status != STATE_OK:
+            status = max(status, field_status)
+            alerts.append(field + "=" + formatValue(values[field]) + " (" + STATE_NAMES[field_status] + ")")
+    return status, alerts
+
+def perfdataValue(label, field, values, uom=''):
+    text = label + "=" + formatValue(values[field]) + uom
+    if field in thresholds:
+        text = text + ";" + thresholds[field].perfdata()
+    return text
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Chek stats
 #
-rocket = RocketChat(args.user, args.password, server_url=args.url)
-stats = rocket.statistics().json()
+try:
+    stats = getStatistics()
+except (RocketAuthenticationException, requests.exceptions.RequestException, ValueError):
+    printVerbose(sys.exc_info())
+    stats = {'success': False}
 if stats['success']:
     printVerbose("Active Users: " + str(stats['activeUsers']))
     printVerbose("Away Users: " + str(stats['awayUsers']))
@@ -80,17 +247,20 @@ if stats['success']:
     printVerbose("Total Uploads: " + str(stats['uploadsTotal']))
     printVerbose("Total Uploads Size: " + str(stats['uploadsTotalSize']))
     printVerbose("Rocket.Chat Version: " + str(stats['version']))
-    exit_satus = STATE_OK
-    exit_message = "OK - STATS: Users: {onlineUsers} online/ {awayUsers} away/ {totalUsers} total, Rooms: {totalRooms}, Messages: {totalMessages}, Uploads: {uploadsTotal}/{uploadsTotalSize}MiB, Version: {version} | online_users={onlineUsers} away_users={awayUsers} total_users={totalUsers} total_rooms={totalRooms} total_messages={totalMessages} total_uploads={uploadsTotal} total_uploads_size={uploadsTotalSize}MiB".format(
-        onlineUsers=str(stats['onlineUsers']),
-        awayUsers=str(stats['awayUsers']),
-        totalUsers=str(stats['totalUsers']),
-        totalRooms=str(stats['totalRooms']),
-        totalMessages=str(stats['totalMessages']),
-        uploadsTotal=str(stats['uploadsTotal']),
-        uploadsTotalSize=str(int(stats['uploadsTotalSize'] / 1024 / 1024)),
-        version=str(stats['version'])
-    )
+    rates = statisticsRates(stats)
+    printVerbose("Rates: " + str(rates))
+    values = statisticsValues(stats, rates)
+    exit_satus, alerts = checkThresholds(values)
+    exit_message = STATE_NAMES[exit_satus] + " - STATS: Users: {onlineUsers} online/ {awayUsers} away/ {totalUsers} total, Rooms: {totalRooms}, Messages: {totalMessages}, Uploads: {uploadsTotal}/{uploadsTotalSizeMiB}MiB, Version: {version}".format(
+        version=str(stats['version']), **values)
+    if rates is not None:
+        exit_message = exit_message + ", Messages/min: {messagesRate:.2f}, Uploads/min: {uploadsRate:.2f}, New users: {usersDelta}".format(**rates)
+    if alerts:
+        exit_message = exit_message + ". Thresholds exceeded: " + ", ".join(alerts)
+    perfdata = [perfdataValue(label, field, values, uom) for label, field, uom in PERFDATA if field in values]
+    perfdata.extend([perfdataValue(field, field, values) for field in sorted(thresholds.keys())
+                     if field in values and field not in [item[1] for item in PERFDATA]])
+    exit_message = exit_message + " | " + " ".join(perfdata)
 else:
     exit_satus = STATE_UNKNOWN
     exit_message = "UNKNOWN - Couldn't get stats from server"
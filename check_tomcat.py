@@ -26,6 +26,12 @@
 # 2- tomcat server memory
 # 3- tomcat server thread connectors
 # 4- application status on tomcat server
+# 5- request, error and byte rates of the thread connectors
+# A collector mode keeps the manager pages of several tomcat servers in memory,
+# the checks with --socket are answered by the collector.
+# A batch mode checks all the tomcat servers of an inventory in one run.
+# Several items can be checked in one run (example: -m status,mem,thread,app),
+# each manager page is read only once for all of them.
 #
 #
 # This plugin conforms to the Nagios Plugin Development Guidelines
@@ -49,11 +55,24 @@
 #   Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 #-------------------------------------------------------------------------------
 
-import argparse, sys
-import urllib2
+import argparse, sys, os
+import httplib
+import urlparse
+import base64
 import socket
-import xml.etree.ElementTree as ET
+import time
+import json
+import threading
+import SocketServer
+import Queue
+import tempfile
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 from math import log
+from nagios_threshold import Threshold, ThresholdError, STATE_NAMES
+from nagios_state import StateStore
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #VARIABLE DEFINITIONS
@@ -76,94 +95,64 @@ mode_help ='''Tomcat monitorizacion mode:
     app:    Application status in tomcat server, the name of the application
             must be defined with the parameter -n or --nameapp.
             This option check the status of java application running on tomcat server
+    rate:   Requests by second, errors by second, processing time by request
+            and bytes sent and received by second of the connectors, since
+            the previous run. Warning and critical values are optional, for
+            the requests by second. The parameter connector is optional.
+    Several modes can be checked in one run, separated by commas
+    (example: status,mem,thread,app). Every manager page is read only once
+    and all the modes are evaluated from the same data.
 '''
-tree_xml=None
-tomcat_version=None
+modes = ['status','mem','thread','app','rate']
 
 #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 #FUNCTIONS
 #-------------------------------------------------------------------------
-#Try if string is a float
-def is_float_try(str):
+#Compile the warning and critical values of a mode, only once for each pair
+#of values. Both ranges must be in or out of range, and the critical range
+#can't be inside the warning range
+threshold_cache = {}
+def compile_threshold(warning,critical):
+    if (warning,critical) in threshold_cache:
+        return threshold_cache[(warning,critical)]
     try:
-        float(str)
-        return True
-    except ValueError:
-        return False
-
-#This function define the range of warning and critical values
-#Return a range --> (min,max,True/False)
-#if True, data must be in a range
-#if False, data must be out of a range
-def define_range(str):
-    if is_float_try(str):
-        range = (0,float(str),True)  # x -> in range(0,x)
-    elif str.count(":")==1:
-        splits = str.split(":")
-        if is_float_try(splits[0]) and is_float_try(splits[1]):
-            range=(float(splits[0]),float(splits[1]),True) # x:y  -> in range(x,y)
-        elif is_float_try(splits[0]) and splits[1]=="":
-            range=(float(splits[0]),float("inf"),True)  # x:  -> in range(x,infinite)
-        elif splits[0]=="~" and is_float_try(splits[1]):
-            range=(float("-inf"),float(splits[1]),True) # ~:x -> in range(-infinite,x)
-        if splits[0][0]=="@" and is_float_try(splits[0].replace("@","")) and is_float_try(splits[1]):
-            range=(float(splits[0].replace("@","")),float(splits[1]),False) # @x:y -> out of range(x,y)
-    else:
-        print "bad range definition in "+str
-        sys.exit(1) #Error in range definition
-    if range[0]<range[1]:
-        return range   # OK
-    else:
-        print "Second value of range "+str+" is less than first value"
-        exit(1)
-
-#Critical and warning function resolve
-#This function return exit_status: OK,WARNING,CRITICAL or UNKNOWN string
-def define_status(value,warning,critical):
-    warning_range = define_range(warning)   #Define warning range
-    critical_range = define_range(critical) #Define critical range
-    val=float(value)                        #The value
-    exit_status="UNKNOWN"                   #status by default
-
-    if args.verbosity:
-        print "Value for test: "+str(value)
-        print "Warning range (min:%s max:%s in_range:%s)"%(str(warning_range[0]),str(warning_range[1]),str(warning_range[2]))
-        print "Critical range (min:%s max:%s in_range:%s)"%(str(critical_range[0]),str(critical_range[1]),str(critical_range[2]))
-        print ""
-
-    #value into the range range(x:y:True)
-    if warning_range[2]==True and critical_range[2]==True:
-        if (warning_range[1]>critical_range[1]) or (warning_range[0]<critical_range[0]):
+        threshold = Threshold(warning,critical)
+    except ThresholdError as e:
+        parser.print_usage()
+        parser.exit(status['UNKNOWN'],"ERROR: %s\n"%(e))
+    warning_range = threshold.warning
+    critical_range = threshold.critical
+    #value into the range range(x:y)
+    if not warning_range.inside and not critical_range.inside:
+        if (warning_range.end>critical_range.end) or (warning_range.start<critical_range.start):
             parser.print_usage()
             parser.exit(3,"ERRROR: critical range (%s) is greater than warning range(%s)\n" % (critical, warning))
-        if value<warning_range[0] or value>warning_range[1]:
-            exit_status="WARNING"
-            if value<critical_range[0] or value>critical_range[1]:
-                exit_status="CRITICAL"
-        else:
-            exit_status="OK"
-
-    #value out of range range(x:y:False)
-    elif warning_range[2]==False and critical_range[2]==False:
-        if (warning_range[1]<critical_range[1]) or (warning_range[0]>critical_range[0]):
+    #value out of range range(@x:y)
+    elif warning_range.inside and critical_range.inside:
+        if (warning_range.end<critical_range.end) or (warning_range.start>critical_range.start):
             parser.print_usage()
             parser.exit(3,"ERRROR: critical range (%s) is greater than warning range(%s)\n" % (critical, warning))
-        if value>warning_range[0] and value<warning_range[1]:
-            exit_status="WARNING"
-            if value>critical_range[0] and value<critical_range[1]:
-                exit_status="CRITICAL"
-        else:
-            exit_status="OK"
     #warning and critical ranges must be both in or out
     else:
         parser.print_usage()
-        parser.exit(status[exit_status],'''
+        parser.exit(status['UNKNOWN'],'''
 ERROR: Both critical and warning values must be in or out of the ranges:
        warning('''+warning+''') and critical ('''+critical+''')\n''')
+    if args.verbosity:
+        print "Warning range (min:%s max:%s in_range:%s)"%(str(warning_range.start),str(warning_range.end),str(not warning_range.inside))
+        print "Critical range (min:%s max:%s in_range:%s)"%(str(critical_range.start),str(critical_range.end),str(not critical_range.inside))
+        print ""
+    threshold_cache[(warning,critical)] = threshold
+    return threshold
 
-    return exit_status
+#Critical and warning function resolve
+#This function return exit_status: OK,WARNING,CRITICAL or UNKNOWN string
+def define_status(value,threshold):
+    if args.verbosity:
+        print "Value for test: "+str(value)
+    return STATE_NAMES[threshold.status(value)]
 
 # convert human readable size function
 def sizeof_fmt(num):
@@ -184,48 +173,191 @@ def sizeof_fmt(num):
     else:
         return None
 
+#Elements of the status xml kept by the streaming parser, the other ones
+#(workers, memory pools...) are discarded as they arrive
+status_xml_elements = ['status','jvm','memory','connector','threadInfo','requestInfo']
+#Elements that appear only once in the status xml, when all the needed
+#elements are of this kind the parser stops when they are found
+status_xml_once = set(['memory'])
+
+#Parse the status xml while it is read, keeping only the needed elements
+#needs is the set of elements that the modes need (None for all of them), an
+#empty set means that only the root element is needed
+#Return the root element and False if the page was not read completely
+def parse_status_XML(source,needs):
+    root = None
+    stack = []
+    found = set()
+    for event,element in ET.iterparse(source,events=('start','end')):
+        if event=='start':
+            if root==None:
+                root = element
+                if needs==set():
+                    return root,False
+            stack.append(element)
+            continue
+        stack.pop()
+        #the workers are counted by stage in their connector before discarding them
+        if element.tag=='worker' and len(stack)>1 and stack[-2].tag=='connector':
+            counter = 'workers_'+element.get('stage','-')
+            stack[-2].set(counter,str(int(stack[-2].get(counter,'0'))+1))
+        if element.tag not in status_xml_elements:
+            element.clear()
+            if stack:
+                stack[-1].remove(element)
+        found.add(element.tag)
+        if needs!=None and needs<=found and needs<=status_xml_once:
+            return root,False
+    return root,True
+
 #open and read XML from tomcat manager/status?XML=true
-def read_page_status_XML(host,port,url,user,password):
+#The page is parsed while it is read, and the reading is stopped when the
+#needed elements are found
+def read_page_status_XML(host,port,url,user,password,needs=None):
 
     url_status_xml = url+"/status?XML=true"
-    page,error_page = read_page(host,port,url_status_xml,user,password)
+    root,error_page = read_page(host,port,url_status_xml,user,password,
+                                lambda source: parse_status_XML(source,needs))
     # End of Open manager status
-    if(error_page):
-        return page,error_page
-    else:
-    # Read xml
+    #show XML tree
+    if args.verbosity>1 and not error_page:
+        print "XML tree:"
+        print ET.dump(root)
+        print ""
+    return root,error_page
+
+#HTTP error status of a manager page, like "HTTP Error 404: Not Found"
+class HTTPStatusError(Exception):
+    def __init__(self,code,reason):
+        Exception.__init__(self,"HTTP Error %i: %s"%(code,reason))
+        self.code = code
+
+#Error connecting with the server
+class ConnectError(Exception):
+    pass
+
+#Pool of keep-alive HTTP connections shared by every request of a run
+#The connections are reused by host and port, and the credentials are sent
+#in the first request (without waiting the 401 challenge of the server)
+class HTTPPool:
+    def __init__(self):
+        self.idle = {}       #idle connections by (host,port)
+        self.lock = threading.Lock()
+        self.stats = {'requests':0, 'opened':0, 'reused':0, 'retried':0}
+
+    def count(self,stat):
+        with self.lock:
+            self.stats[stat] = self.stats[stat]+1
+
+    #Return an idle connection (if reuse) or a new one, and if it is reused
+    def connection(self,host,port,reuse=True):
+        with self.lock:
+            connections = self.idle.get((host,port))
+            if reuse and connections:
+                self.stats['reused'] = self.stats['reused']+1
+                return connections.pop(),True
+        connection = httplib.HTTPConnection(host,int(port),timeout=socket.getdefaulttimeout())
         try:
-            root = ET.fromstring(page)
-        #If can't parse XML
-        except ET.ParseError as e:
-            root="ERROR: I Can't understand the XML page. Error: %s" %(e)
-            error_page=True
-        #show XML tree
-        if args.verbosity>1:
-            print "XML tree:"
-            print ET.dump(root)
-            print ""
-        return root,error_page
+            connection.connect()
+        except socket.timeout:
+            raise
+        except socket.error as e:
+            raise ConnectError(e)
+        self.count('opened')
+        return connection,False
+
+    #Open a page, return the connection and the response
+    #The response must be read and then released with release()
+    def open(self,host,port,url,user,password):
+        headers = {'Authorization':'Basic '+base64.b64encode(user+":"+password)}
+        for redirect in range(4):
+            connection,reused = self.connection(host,port)
+            self.count('requests')
+            try:
+                connection.request("GET",url,None,headers)
+                response = connection.getresponse()
+            except (socket.error,httplib.HTTPException):
+                connection.close()
+                #the server closed an idle connection, try again with a new one
+                if not reused:
+                    raise
+                self.count('retried')
+                connection,reused = self.connection(host,port,False)
+                connection.request("GET",url,None,headers)
+                response = connection.getresponse()
+            if response.status in (301,302,303,307) and response.getheader('location'):
+                location = urlparse.urlsplit(response.getheader('location'))
+                self.release(connection,response)
+                if location.hostname not in (None,host) or str(location.port or port)!=str(port):
+                    raise HTTPStatusError(response.status,"redirect to other server "+location.geturl())
+                url = location.path+(location.query and "?"+location.query)
+                continue
+            if response.status!=200:
+                reason = response.reason
+                self.release(connection,response)
+                raise HTTPStatusError(response.status,reason)
+            return connection,response
+        raise HTTPStatusError(response.status,"too many redirects")
+
+    #Return the connection to the pool if the response was read completely
+    #and the server keeps the connection alive
+    def release(self,connection,response):
+        if not response.isclosed():
+            try:
+                response.read()
+            except (socket.error,httplib.HTTPException):
+                pass
+        if response.will_close:
+            connection.close()
+            return
+        with self.lock:
+            self.idle.setdefault((connection.host,str(connection.port)),[]).append(connection)
+
+    #Read a page, completely or with reader(response)
+    #If the reader does not read the complete page the connection is closed
+    def read(self,host,port,url,user,password,reader=None):
+        connection,response = self.open(host,port,url,user,password)
+        try:
+            if reader==None:
+                page,complete = response.read(),True
+            else:
+                page,complete = reader(response)
+        except:
+            connection.close()
+            raise
+        if complete:
+            self.release(connection,response)
+        else:
+            connection.close()
+        return page
+
+    #Print the statistics of the connections
+    def print_stats(self):
+        print "http requests:%(requests)i connections opened:%(opened)i reused:%(reused)i retried:%(retried)i"%(self.stats)
+
+http_pool = HTTPPool()
+
+#True if the error of a page is "404 Not Found"
+def not_found(page):
+    return page.find("HTTP Error 404")!=-1
 
 #Read a html manager page
-def read_page(host,port,url,user,password):
+#If reader is defined, the page is read by reader(response), that returns the
+#page and False if it stopped reading before the end of the page
+def read_page(host,port,url,user,password,reader=None):
     error=False
     url_tomcat = "http://"+host+":"+port+url
     if args.verbosity:
         print "connection url: %s\n"%(url_tomcat)
 
     try:
-        password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(None,url_tomcat,user,password)
-        handler = urllib2.HTTPBasicAuthHandler(password_mgr)
-        opener=urllib2.build_opener(handler)
-        urllib2.install_opener(opener)
-        req = urllib2.Request(url_tomcat)
-        handle = urllib2.urlopen(req, None)
         # Store all page in a variable
-        page = handle.read()
+        page = http_pool.read(host,port,url,user,password,reader)
         # End of Open manager status
-    except urllib2.HTTPError as e:
+    except ET.ParseError as e:
+        page="ERROR: I Can't understand the XML page. Error: %s" %(e)
+        error=True
+    except HTTPStatusError as e:
         if(e.code==401):
             page="ERROR: Unauthorized, your user not have permissions. %s" %(e)
         elif(e.code==403):
@@ -233,26 +365,825 @@ def read_page(host,port,url,user,password):
         else:
             page="ERROR: The server couldn\'t fulfill the request. %s" %(e)
         error=True
-    except urllib2.URLError as e:
-       page = 'ERROR: We failed to reach a server. Reason: %s' %(e.reason)
+    except ConnectError as e:
+       page = 'ERROR: We failed to reach a server. Reason: %s' %(e)
        error = True
     except socket.timeout as e:
         page = 'ERROR: Timeout error'
         error = True
-    except socket.error as e:
-       page = "ERROR: Dammit! I can't connect with host "+args.host+":"+args.port
+    except (socket.error,httplib.HTTPException) as e:
+       page = "ERROR: Dammit! I can't connect with host "+host+":"+port
        error = True
     except:
        page = "ERROR: Unexpected error (I'm damned if I know!): %s"%(sys.exc_info()[0])
        error = True
 
     # Show page if -vvv option
-    if args.verbosity>2:
+    if args.verbosity>2 and (reader==None or error):
         print "page "+url_tomcat+" content:"
         print page
         print ""
     return page,error
 
+
+#Read the value of a warning or critical parameter for a mode
+#The parameter can be a single value for all modes ("80") or a value by mode
+#("mem=80,thread=90"). Return None if the mode has no value.
+def mode_threshold(value,mode):
+    if value==None or value.find("=")==-1:
+        return value
+    for item in value.split(","):
+        name,sep,item_value = item.partition("=")
+        if name.strip()==mode:
+            return item_value.strip()
+    return None
+
+#Tomcat manager pages of a server
+#Each manager page is read at most once, so several modes can be evaluated
+#from the same data without new requests
+class TomcatManager:
+    def __init__(self,host,port,url,user,password,cache_path=None,version_ttl=0):
+        self.host = host
+        self.port = port
+        self.url = url
+        self.user = user
+        self.password = password
+        self.pages = {}           #read pages by url: (page,error)
+        self.info = None          #parsed serverinfo
+        self.status_xml = None    #parsed status xml: (tree_xml,error)
+        self.status_time = None   #time when the status xml was read
+        self.collected = False    #True if the pages were read by the collector
+        self.needs = None         #elements of the status xml needed, None for all
+        self.cache_path = cache_path    #state file with the version cache
+        self.version_ttl = version_ttl  #seconds that the cached version is valid
+        self.cached = None        #cached version and layout
+        self.cache_loaded = False
+
+    #Read the version and layout of the manager from the version cache
+    #Return a dictionary with the keys version and layout, or None if they
+    #are not cached or are older than version_ttl
+    def cached_version(self):
+        if self.cache_path==None:
+            return None
+        if not self.cache_loaded:
+            self.cache_loaded = True
+            try:
+                with StateStore(self.cache_path) as store:
+                    last = store.last('version')
+            except (IOError,OSError) as e:
+                state_error(self.cache_path,e)
+                last = None
+            if last!=None and time.time()-last[0]<self.version_ttl:
+                #the unknown version is saved as NaN
+                version = last[1]['version']
+                if version==version:
+                    version = str(int(version))
+                else:
+                    version = None
+                layout = 'legacy'
+                if last[1]['text']:
+                    layout = 'text'
+                self.cached = {'version':version,'layout':layout}
+                if args.verbosity>1:
+                    print "cached tomcat version:%s layout:%s\n"%(self.cached['version'],self.cached['layout'])
+        return self.cached
+
+    #Save the version and layout of the manager in the version cache
+    def cache_version(self,version,layout):
+        if self.cache_path==None:
+            return
+        cached = self.cached_version()
+        if cached!=None and cached['version']==version and cached['layout']==layout:
+            return
+        try:
+            with StateStore(self.cache_path) as store:
+                store.set('version',{'version':version,'text':int(layout=='text')})
+        except (IOError,OSError) as e:
+            state_error(self.cache_path,e)
+        self.cached = {'version':version,'layout':layout}
+
+    #Drop the cached version and layout, used when a cached path is not found
+    def drop_version(self):
+        if args.verbosity:
+            print "the cached manager layout is not valid, dropped\n"
+        self.cached = None
+        try:
+            with StateStore(self.cache_path) as store:
+                store.delete('version')
+        except (IOError,OSError) as e:
+            state_error(self.cache_path,e)
+
+    #Read a manager page only the first time
+    def read(self,url):
+        if url not in self.pages and self.collected:
+            return "ERROR: The page "+url+" was not read by the collector",True
+        if url not in self.pages:
+            self.pages[url] = read_page(self.host,self.port,url,self.user,self.password)
+        elif args.verbosity>1:
+            print "page %s already read\n"%(url)
+        return self.pages[url]
+
+    #Read and parse the serverinfo page
+    #Return a dictionary with the keys: error, page, url, version,
+    #version_string and status_string
+    def serverinfo(self):
+        if self.info!=None:
+            return self.info
+        url_list = [self.url+"/serverinfo",self.url+"/text/serverinfo"]
+        # with the text interface in the version cache, it is tried first
+        cached = self.cached_version()
+        if cached!=None and cached['layout']=='text':
+            url_list.reverse()
+        url_serverinfo = url_list[0]
+        page_serverinfo,error_serverinfo = self.read(url_serverinfo)
+        if args.verbosity>2:
+            print "serverinfo:"
+            print page_serverinfo
+
+        # if error, try the manager/text/serverinfo, because in tomcat 7 change the path
+        # of the manager app commands
+        if(error_serverinfo):
+            if cached!=None and not_found(page_serverinfo):
+                self.drop_version()
+            url_serverinfo = url_list[1]
+            page_serverinfo,error_serverinfo = self.read(url_serverinfo)
+        self.info = {'error':error_serverinfo, 'page':page_serverinfo,
+                     'url':url_serverinfo, 'version':None, 'layout':None,
+                     'version_string':None, 'status_string':None}
+        # Now it is an error yes or yes
+        if(error_serverinfo==False):
+            # read tomcat version in serverinfo
+            serverinfo = page_serverinfo.splitlines()
+            if args.verbosity>1:
+                print "Server info split: "
+                print serverinfo
+                print ""
+            tomcat_version_string = (serverinfo[1].split(":"))[1]
+            tomcat_status_string = serverinfo[0]
+            if args.verbosity>2:
+                print "tomcat_version_string: "+tomcat_version_string
+                print "tomcat_status_string: "+tomcat_status_string
+            #tomcat version is read in line 2 of serverinfo
+            #example:" Apache Tomcat/7.0.53", choose the "7"
+            tomcat_version = (tomcat_version_string.split("/"))[1].split(".")[0]
+            if args.verbosity:
+                print "tomcat_version: "+tomcat_version
+            #If i can't read the tomcat version because it is not a number
+            if (tomcat_version.isdigit()==False):
+                tomcat_version=0
+                if args.verbosity:
+                    print "WARNING: I can't read the tomcat version"
+            #for versions upper Tomcat 6 the commands are in the text interface
+            if int(tomcat_version) > 6 or url_serverinfo==self.url+"/text/serverinfo":
+                layout = 'text'
+            else:
+                layout = 'legacy'
+            self.info['version'] = tomcat_version
+            self.info['layout'] = layout
+            self.info['version_string'] = tomcat_version_string
+            self.info['status_string'] = tomcat_status_string
+            self.cache_version(tomcat_version,layout)
+        return self.info
+
+    #Read and parse the status xml page only the first time
+    def status(self):
+        if self.status_xml==None:
+            self.status_time = time.time()
+            self.status_xml = read_page_status_XML(self.host,self.port,self.url,
+                                                   self.user,self.password,self.needs)
+        return self.status_xml
+
+    #Layout of the manager commands: "text" for the text interface (tomcat 7
+    #and upper) and "legacy" for older versions, from the serverinfo page or
+    #the version cache. None if the serverinfo page can't be read
+    def layout(self):
+        if self.info==None:
+            cached = self.cached_version()
+            if cached!=None:
+                return cached['layout']
+        return self.serverinfo()['layout']
+
+    #Manager command url, for versions upper Tomcat 6 the commands are in
+    #the text interface
+    def command_url(self,command):
+        if self.layout()=='text':
+            return self.url+"/text/"+command
+        else:
+            return self.url+"/"+command
+
+    #Read a manager command page
+    #If the layout is not known, the serverinfo page is not requested only for
+    #this: the text interface (tomcat 7 and upper) is tried first and then the
+    #old interface. A cached layout that is not found is dropped.
+    def read_command(self,command):
+        if self.info==None and self.cached_version()==None:
+            page,error = self.read(self.url+"/text/"+command)
+            layout = 'text'
+            if error:
+                page,error = self.read(self.url+"/"+command)
+                layout = 'legacy'
+            if not error:
+                self.cache_version(None,layout)
+            return page,error
+        page,error = self.read(self.command_url(command))
+        if error and self.info==None and not_found(page):
+            self.drop_version()
+            return self.read_command(command)
+        return page,error
+
+    #Read the resources of the manager that the modes need
+    def fetch(self,resources):
+        if 'serverinfo' in resources:
+            self.serverinfo()
+        if 'status' in resources:
+            self.status()
+        if 'list' in resources and self.layout()!=None:
+            self.read_command("list")
+
+#Mode functions
+#Each mode function return a tuple (exit_status,output,perfdata)
+
+# status mode
+#-----------------------------------------------------------------------------
+def check_status(manager,opts):
+    info = manager.serverinfo()
+    # If serverinfo page is correct
+    if (info['error']!=True):
+        # check if the first line of serverinfo content "OK"
+        if (info['status_string'].find("OK")!=-1):
+            return 'OK',info['version_string']+" server is OK",""
+        else:
+            return 'UNKNOWN',"This server is not a tomcat server or "+info['url']+" is not the manager app server info page",""
+    # if serverinfo page is not correct try with th status xml page
+    tree_xml,error_status_xml = manager.status()
+    #check if page status xml is OK
+    if (error_status_xml!=True):
+        if (tree_xml!=None):
+            if tree_xml.tag=='status':    #The first tag of xml is "status"
+                return 'OK',"The Tomcat server is OK, but page serverinfo not work",""
+            else:
+                return 'UNKNOWN',"This server is not a tomcat server or not status xml page",""
+        else:
+            return 'CRITICAL',"I can't read either serviceinfo or serverstatus, this server not seems a Tomcat Server",""
+    else:
+        return 'CRITICAL',tree_xml,""
+
+# mem mode
+#-----------------------------------------------------------------------------
+def check_mem(manager,opts):
+    warning = mode_threshold(opts.warning,'mem')
+    critical = mode_threshold(opts.critical,'mem')
+    # read status xml for extract mem data
+    tree_xml,error_status_xml = manager.status()
+    if error_status_xml:
+        return 'WARNING',tree_xml,""
+    if tree_xml==None:
+        return 'UNKNOWN',"",""
+    memory = tree_xml.find('.//memory')
+    free_memory = float(memory.get('free'))
+    total_memory = float(memory.get('total'))
+    max_memory = float(memory.get('max'))
+    available_memory = free_memory + max_memory - total_memory
+    used_memory = max_memory - available_memory
+    percent_used_memory = float((used_memory * 100)/max_memory)
+    if args.verbosity:
+        print "mode: mem(memory)"
+        if args.verbosity > 1:
+            print "free:%0.1f total:%0.1f max:%0.1f available:%0.1f used:%0.1f percent_used:%0.2f"%(free_memory,
+                                    total_memory,max_memory,available_memory,used_memory,percent_used_memory)
+        print "free_memory:%s total memory:%s max_memory:%s"%(sizeof_fmt(free_memory),sizeof_fmt(total_memory),sizeof_fmt(max_memory))
+        print "available_memory = free_memory + max_memory - total_memory -->  %s" %(sizeof_fmt(available_memory))
+        print "used_memory = max_memory - available_memory -->  %s" %(sizeof_fmt(used_memory))
+        print "percent_used_memory = (used_memory * 100)/max_memory  -->  %0.2f%%\n"%(percent_used_memory)
+
+    #Define status whit function
+    exit_status=define_status(percent_used_memory,compile_threshold(warning,critical))
+    output="Used memory "+sizeof_fmt(used_memory)+" of "+sizeof_fmt(max_memory)+"(%0.2f%%)" %(percent_used_memory)
+    perfdata="'Used_memory'=%0.0f%%;%s;%s"%(percent_used_memory,warning,critical)
+    return exit_status,output,perfdata
+
+# thread mode
+#-----------------------------------------------------------------------------
+def check_thread(manager,opts):
+    warning = mode_threshold(opts.warning,'thread')
+    critical = mode_threshold(opts.critical,'thread')
+    exit_status = 'OK'
+    output = ""
+    perfdata = ""
+    # read status xml for extract thread data
+    tree_xml,error_status_xml = manager.status()
+    if error_status_xml:
+        return 'WARNING',tree_xml,""
+    if tree_xml==None:
+        return 'UNKNOWN',"",""
+    threshold = compile_threshold(warning,critical)
+    if(opts.connector==None):
+        if (args.verbosity>0): print "Finding all connectors"
+        prefix = '/connector'
+    else:
+        if (args.verbosity>0): print "Finding %s connector"%(opts.connector)
+        prefix = 'connector'
+    connectors = []
+    for connector in tree_xml.findall('./connector'):
+        connector_name = str(connector.get('name'))
+        if (opts.connector==None) or (opts.connector==connector_name):
+            if (args.verbosity>0): print "Find %s connector"%(connector_name)
+            thread = connector.find('./threadInfo')
+            max_thread = float(thread.get('maxThreads'))
+            busy_thread = float(thread.get('currentThreadsBusy'))
+            connectors.append((connector_name,busy_thread,max_thread))
+
+    #All the connectors are evaluated with the same threshold
+    percents_used_thread = [float((busy_thread * 100)/max_thread) for connector_name,busy_thread,max_thread in connectors]
+    if args.verbosity:
+        print "Values for test: "+str(percents_used_thread)
+    for (connector_name,busy_thread,max_thread),iter_status in zip(connectors,threshold.statuses(percents_used_thread)):
+        if iter_status > status[exit_status]:
+            exit_status=STATE_NAMES[iter_status]
+        output = output + '%s:%s %0.0f threads busy of %0.0f '%(prefix,connector_name,busy_thread,max_thread)
+        perfdata = perfdata + "'conn %s'=%0.0f;%s;%s;0;%0.0f "%(connector_name,busy_thread,warning,critical,max_thread)
+    return exit_status,output,perfdata
+
+# app mode
+#-----------------------------------------------------------------------------
+def check_app(manager,opts):
+    #If serverinfo is not read (and the layout is not cached)
+    if manager.layout()==None:
+        return 'UNKNOWN',"I can't read the serverinfo page. "+manager.serverinfo()['page'],""
+
+    #read application list page
+    page_list,error_list = manager.read_command("list")
+    #If list page is not read
+    if error_list:
+        return 'UNKNOWN',"I can't read the list page of tomcat manager "+page_list,""
+    #Divide page_list in lines, each line is an application in the tomcat server
+    applist = page_list.splitlines()
+    if args.verbosity>1:
+        print "page_list split:"
+        print applist
+        print ""
+    #Applications in page list are like "/the_name_of_the_app"
+    matchapp = "/"+opts.nameapp
+    for application in applist:
+        application = application.split(":")
+        if matchapp == application[0]:
+            #perfdata is the number of sessions for the application
+            perfdata="'sessions'="+application[2]
+            if application[1]=="running":
+                return "OK",opts.nameapp+" is running",perfdata
+            elif application[1]=="stopped":
+                return "WARNING",opts.nameapp+" is stopped",perfdata
+            else:
+                return "WARNING","I can't understand the state "+application[1],perfdata
+    #If not match app
+    return "CRITICAL","I can't find the "+matchapp+" application in the tomcat server",""
+
+# rate mode
+#-----------------------------------------------------------------------------
+#Counters of requestInfo used for the rates, the previous sample of each
+#connector is kept in the state file of the server
+rate_counters = ['requestCount','errorCount','processingTime','bytesSent','bytesReceived']
+
+def check_rate(manager,opts):
+    warning = mode_threshold(opts.warning,'rate')
+    critical = mode_threshold(opts.critical,'rate')
+    exit_status = 'OK'
+    output = ""
+    perfdata = ""
+    # read status xml for extract request data
+    tree_xml,error_status_xml = manager.status()
+    if error_status_xml:
+        return 'WARNING',tree_xml,""
+    if tree_xml==None:
+        return 'UNKNOWN',"",""
+    threshold = None
+    if (warning!=None) and (critical!=None):
+        threshold = compile_threshold(warning,critical)
+    connectors = []
+    for connector in tree_xml.findall('./connector'):
+        connector_name = str(connector.get('name'))
+        request = connector.find('./requestInfo')
+        if (request==None) or (opts.connector!=None and opts.connector!=connector_name):
+            continue
+        if (args.verbosity>0): print "Find %s connector"%(connector_name)
+        sample = {}
+        for counter in rate_counters:
+            sample[counter] = float(request.get(counter,0))
+        connectors.append((connector_name,connector,sample))
+    #without a previous sample, or if tomcat was restarted, there are no rates
+    connector_rates = {}
+    path = state_path(opts.cache_dir,manager.host,manager.port,manager.url)
+    try:
+        with StateStore(path) as store:
+            for connector_name,connector,sample in connectors:
+                last = store.last('rate '+connector_name)
+                if (last!=None) and (last[0]>=manager.status_time):
+                    #same snapshot of the collector as the last run: the rates
+                    #of the last run are reported again
+                    previous = store.last('rates '+connector_name)
+                    connector_rates[connector_name] = previous and previous[1]
+                    continue
+                rates = store.rate('rate '+connector_name,sample,manager.status_time)
+                store.add('rate '+connector_name,sample,manager.status_time)
+                if rates==None:
+                    store.delete('rates '+connector_name)
+                else:
+                    store.set('rates '+connector_name,rates,manager.status_time)
+                connector_rates[connector_name] = rates
+    except (IOError,OSError) as e:
+        state_error(path,e)
+        return 'UNKNOWN',"ERROR: I can't use the state file %s: %s"%(path,e),""
+    for connector_name,connector,sample in connectors:
+        rates = connector_rates[connector_name]
+        #workers by stage (S:service, K:keepalive, R:ready, P:parse...)
+        for name,value in sorted(connector.items()):
+            if name.startswith('workers_'):
+                perfdata = perfdata + "'conn %s workers %s'=%s;;;0 "%(connector_name,name[8:],value)
+        if rates==None:
+            output = output + 'connector:%s first sample, rates in the next run '%(connector_name)
+            continue
+        request_rate = rates['requestCount']
+        error_rate = rates['errorCount']
+        time_per_request = 0
+        if request_rate>0:
+            time_per_request = rates['processingTime']/request_rate
+        sent_rate = rates['bytesSent']
+        received_rate = rates['bytesReceived']
+        if args.verbosity>1:
+            print "rates by second: %s"%(rates)
+        if threshold!=None:
+            iter_status = define_status(request_rate,threshold)
+            if status[iter_status] > status[exit_status]:
+                exit_status = iter_status
+        output = output + 'connector:%s %0.2f req/s %0.2f errors/s %0.1f ms/req %s/s sent %s/s received '%(connector_name,
+                 request_rate,error_rate,time_per_request,sizeof_fmt(sent_rate),sizeof_fmt(received_rate))
+        perfdata = perfdata + "'conn %s requests'=%0.3f;%s;%s;0 "%(connector_name,request_rate,warning or "",critical or "")
+        perfdata = perfdata + "'conn %s errors'=%0.3f;;;0 "%(connector_name,error_rate)
+        perfdata = perfdata + "'conn %s time'=%0.1fms;;;0 "%(connector_name,time_per_request)
+        perfdata = perfdata + "'conn %s sent'=%0.0fB;;;0 "%(connector_name,sent_rate)
+        perfdata = perfdata + "'conn %s received'=%0.0fB;;;0 "%(connector_name,received_rate)
+    return exit_status,output,perfdata
+
+mode_functions = {'status':check_status, 'mem':check_mem,
+                  'thread':check_thread, 'app':check_app, 'rate':check_rate}
+#Manager resources needed by each mode: serverinfo page, status xml and
+#application list
+mode_resources = {'status':['serverinfo'], 'mem':['status'],
+                  'thread':['status'], 'app':['serverinfo','list'],
+                  'rate':['status']}
+#Elements of the status xml needed by each mode
+mode_status_needs = {'status':set(), 'mem':set(['memory']),
+                     'thread':set(['threadInfo']), 'app':set(),
+                     'rate':set(['requestInfo'])}
+
+#Control the parameters requiered by the modes before any request
+def check_parameters(opts,mode_list):
+    for mode in mode_list:
+        if mode in ['mem','thread']:
+            if (mode_threshold(opts.warning,mode)==None) or (mode_threshold(opts.critical,mode)==None):
+                parser.print_usage()
+                parser.exit(status['UNKNOWN'],
+                            'ERROR: Warning and critical values requiered with mode "%s"\n'%(mode))
+            compile_threshold(mode_threshold(opts.warning,mode),mode_threshold(opts.critical,mode))
+        if mode=='rate' and (mode_threshold(opts.warning,mode)!=None) and (mode_threshold(opts.critical,mode)!=None):
+            compile_threshold(mode_threshold(opts.warning,mode),mode_threshold(opts.critical,mode))
+        if mode=='app' and opts.nameapp==None:
+            parser.print_usage()
+            parser.exit(status['UNKNOWN'],
+                        'ERROR: nameapp value requiered with mode "app"\n')
+
+#Evaluate the modes from the same manager pages
+#Return a list of tuples (mode,exit_status,output,perfdata)
+def check_modes(manager,opts,mode_list):
+    results = []
+    #The status xml is parsed only for the elements that the modes need
+    if manager.status_xml==None and not manager.collected:
+        manager.needs = set()
+        for mode in mode_list:
+            manager.needs = manager.needs | mode_status_needs[mode]
+    if args.verbosity>1:
+        resources = []
+        for mode in mode_list:
+            resources = resources + [resource for resource in mode_resources[mode] if resource not in resources]
+        print "manager resources needed: %s\n"%(",".join(resources))
+    for mode in mode_list:
+        if args.verbosity:
+            print "mode: %s"%(mode)
+        exit_status,output,perfdata = mode_functions[mode](manager,opts)
+        if output=='':
+            output = "ERROR: no output"
+            exit_status ='UNKNOWN'
+        results.append((mode,exit_status,output,perfdata))
+    return results
+
+#Path of the state file of a tomcat server, where the values kept between
+#runs are saved (see nagios_state.py)
+def state_path(cache_dir,host,port,url):
+    name = "check_tomcat_%s_%s_%s.state"%(host,port,url.strip("/").replace("/","_"))
+    return os.path.join(cache_dir,name)
+
+#The state file can't be read or written, the check goes on without it
+def state_error(path,error):
+    if args.verbosity:
+        print "I can't use the state file %s: %s"%(path,error)
+
+#Create the manager of a tomcat server, with the version cache in its state
+#file (without version cache if --version-ttl is 0)
+def new_manager(host,port,url,user,password,opts):
+    cache_path = None
+    if float(opts.version_ttl)>0:
+        cache_path = state_path(opts.cache_dir,host,port,url)
+    return TomcatManager(host,port,url,user,password,cache_path,
+                         float(opts.version_ttl))
+
+#Decide if the sessions must be expired in this run
+#With --expire-every N the sessions are expired once every N runs, the runs
+#are counted in the state file of the server
+def expire_due(manager,opts):
+    if opts.no_expire:
+        return False
+    every = int(opts.expire_every)
+    if every<=1:
+        return True
+    path = state_path(opts.cache_dir,manager.host,manager.port,manager.url)
+    try:
+        with StateStore(path) as store:
+            last = store.last('expire')
+            runs = 1
+            if last!=None:
+                runs = last[1]['runs']+1
+            due = runs>=every
+            if due:
+                runs = 0
+            store.set('expire',{'runs':runs})
+    except (IOError,OSError) as e:
+        state_error(path,e)
+        return True
+    return due
+
+#Expire sessions of manager app
+def expire_sessions(manager,opts):
+    if not expire_due(manager,opts):
+        if args.verbosity>1:
+            print "Expire sessions skipped"
+        return
+    #If serverinfo was read with errors
+    if manager.info!=None and manager.info['error']:
+        return
+    page_expire,error_expire = manager.read_command("expire?path="+manager.url+"&idle="+opts.expire_time)
+    if (args.verbosity>0):
+        if not error_expire:
+            print("Expire sessions of "+manager.url)
+        if (args.verbosity>1):
+            print("Expire information:")
+            print(page_expire)
+
+#Combine the results of several modes in one message
+#The exit status is the worst status of the modes
+def combine_results(results):
+    if len(results)==1:
+        mode,exit_status,output,perfdata = results[0]
+        return exit_status,output,perfdata
+    exit_status = 'OK'
+    outputs = []
+    perfdatas = []
+    for mode,mode_status,output,perfdata in results:
+        if status[mode_status] > status[exit_status]:
+            exit_status = mode_status
+        outputs.append("%s: %s %s"%(mode,mode_status,output.strip()))
+        if perfdata!="":
+            perfdatas.append(perfdata.strip())
+    return exit_status,", ".join(outputs)," ".join(perfdatas)
+
+#Send the result of each mode as a passive check result
+#The results are written in the nagios external command file, without it the
+#lines are returned to be printed after the output of the check (nagios takes
+#the first line of the standard output as the output of the check)
+def send_passive_results(results,host,service,command_file):
+    timestamp = int(time.time())
+    lines = ""
+    for mode,exit_status,output,perfdata in results:
+        message = output
+        if perfdata!="":
+            message = message + '|' + perfdata
+        lines = lines + "[%i] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%i;%s\n"%(timestamp,
+                 host,service%{'mode':mode},status[exit_status],message)
+    if command_file==None:
+        return lines
+    cmd = open(command_file,"a")
+    try:
+        cmd.write(lines)
+    finally:
+        cmd.close()
+    return ""
+
+#Collector
+#-----------------------------------------------------------------------------
+#The collector reads the manager pages of several tomcat servers every
+#interval, and answers the checks of the thin clients over a local UNIX socket
+#from the pages in memory.
+snapshots = {}    #collected managers by (host,port,url): (timestamp,manager)
+
+#Read the tomcat servers of an inventory file (or standard input with "-")
+#Each line is "host port [url [user [password]]]", the missing values are
+#taken from the default parameters. Lines starting with "#" are comments.
+def read_inventory(inventory,opts):
+    if inventory=="-":
+        lines = sys.stdin.readlines()
+    else:
+        inventory_file = open(inventory)
+        try:
+            lines = inventory_file.readlines()
+        finally:
+            inventory_file.close()
+    servers = []
+    for line in lines:
+        fields = line.split()
+        if fields==[] or fields[0].startswith("#"):
+            continue
+        defaults = [None,None,opts.URL,opts.user,opts.authentication]
+        if len(fields)<2 or len(fields)>len(defaults):
+            raise ValueError("bad inventory line: "+line.strip())
+        servers.append(tuple(fields+defaults[len(fields):]))
+    return servers
+
+#Read all the pages that the modes need from a tomcat server
+def collect_manager(host,port,url,user,password,opts):
+    manager = new_manager(host,port,url,user,password,opts)
+    resources = []
+    for mode in modes:
+        resources = resources + mode_resources[mode]
+    manager.fetch(resources)
+    expire_sessions(manager,opts)
+    manager.collected = True
+    return manager
+
+#Answer a check request of a thin client with the collected pages
+def collector_response(request):
+    key = (request['host'],request['port'],request['url'])
+    if key not in snapshots:
+        return {'error':"ERROR: The collector has no data of %s:%s%s"%key}
+    timestamp,manager = snapshots[key]
+    age = time.time()-timestamp
+    if age>float(args.ttl):
+        return {'error':"ERROR: The collected data of %s:%s%s is too old (%is)"%(key+(age,))}
+    opts = argparse.Namespace(**request['options'])
+    return {'age':age,'results':check_modes(manager,opts,request['modes'])}
+
+#Handler of the thin client requests, one json line by request
+class CollectorHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            response = collector_response(request)
+        except (ValueError,KeyError,TypeError) as e:
+            response = {'error':"ERROR: Bad collector request. %s"%(e)}
+        self.wfile.write(json.dumps(response)+"\n")
+
+#Run the collector, never return
+def run_collector(opts):
+    try:
+        servers = read_inventory(opts.inventory,opts)
+    except (IOError,ValueError) as e:
+        print "UNKNOWN ERROR: I can't read the inventory. %s"%(e)
+        sys.exit(status['UNKNOWN'])
+    if os.path.exists(opts.socket):
+        os.remove(opts.socket)
+    server = SocketServer.ThreadingUnixStreamServer(opts.socket,CollectorHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    if args.verbosity:
+        print "collector listening in %s, %i tomcat servers"%(opts.socket,len(servers))
+    def collect(server):
+        host,port,url,user,password = server
+        snapshots[(host,port,url)] = (time.time(),
+            collect_manager(host,port,url,user,password,opts))
+    while True:
+        start = time.time()
+        #The servers that do not answer in time keep the last data until ttl
+        fan_out(collect,servers,int(opts.workers),float(opts.host_timeout))
+        if args.verbosity:
+            print "collected %i tomcat servers in %0.2fs"%(len(servers),time.time()-start)
+        if args.verbosity>1:
+            http_pool.print_stats()
+        time.sleep(max(0,float(opts.interval)-(time.time()-start)))
+
+#Batch
+#-----------------------------------------------------------------------------
+#Run function(server) for every server in threads, with at most "workers"
+#servers at the same time. A server that takes more than host_timeout seconds
+#is abandoned, so the total time is bounded by the slowest servers and not by
+#the sum of all of them.
+#Return a list with the result of each server, None if the server timed out
+def fan_out(function,servers,workers,host_timeout):
+    results = [None]*len(servers)
+    done = Queue.Queue()
+    def worker(index):
+        try:
+            result = function(servers[index])
+        except Exception as e:
+            result = e
+        done.put((index,result))
+    pending = range(len(servers))
+    running = {}    #start time of running servers by index
+    while pending or running:
+        while pending and len(running)<workers:
+            index = pending.pop(0)
+            thread = threading.Thread(target=worker,args=(index,))
+            thread.daemon = True
+            running[index] = time.time()
+            thread.start()
+        next_timeout = min(running.values())+host_timeout
+        try:
+            index,result = done.get(True,max(0.001,next_timeout-time.time()))
+            #late results of abandoned servers are ignored
+            if index in running:
+                del running[index]
+                results[index] = result
+        except Queue.Empty:
+            pass
+        now = time.time()
+        for index,start in running.items():
+            if now-start>=host_timeout:
+                if args.verbosity:
+                    print "timeout of server %s:%s"%(servers[index][0],servers[index][1])
+                del running[index]
+    return results
+
+#Check the modes of a server of the inventory
+def check_server(server,opts,mode_list):
+    host,port,url,user,password = server
+    manager = new_manager(host,port,url,user,password,opts)
+    results = check_modes(manager,opts,mode_list)
+    expire_sessions(manager,opts)
+    return results
+
+#Check the modes of all the servers of the inventory, never return
+#A line by server and mode is printed, or a passive result if --passive
+def run_batch(opts,mode_list):
+    try:
+        servers = read_inventory(opts.inventory,opts)
+    except (IOError,ValueError) as e:
+        print "UNKNOWN ERROR: I can't read the inventory. %s"%(e)
+        sys.exit(status['UNKNOWN'])
+    start = time.time()
+    batch_results = fan_out(lambda server: check_server(server,opts,mode_list),
+                            servers,int(opts.workers),float(opts.host_timeout))
+    exit_status = 'OK'
+    for server,results in zip(servers,batch_results):
+        if results==None:
+            results = [(mode,'UNKNOWN',"ERROR: Timeout error, no answer in %ss"%(opts.host_timeout),"") for mode in mode_list]
+        elif isinstance(results,Exception):
+            results = [(mode,'UNKNOWN',"ERROR: Unexpected error (I'm damned if I know!): %s"%(results),"") for mode in mode_list]
+        for mode,mode_status,output,perfdata in results:
+            if status[mode_status] > status[exit_status]:
+                exit_status = mode_status
+        if opts.passive:
+            try:
+                sys.stdout.write(send_passive_results(results,server[0],opts.passive_service,opts.command_file))
+            except (IOError,OSError) as e:
+                print "UNKNOWN ERROR: I can't write the passive results. %s"%(e)
+                sys.exit(status['UNKNOWN'])
+            continue
+        for mode,mode_status,output,perfdata in results:
+            message = "%s:%s %s %s %s"%(server[0],server[1],mode,mode_status,output.strip())
+            if perfdata!="":
+                message = message + '|' + perfdata.strip()
+            print message
+    if args.verbosity:
+        print "checked %i tomcat servers in %0.2fs"%(len(servers),time.time()-start)
+    if args.verbosity>1:
+        http_pool.print_stats()
+    sys.exit(status[exit_status])
+
+#Ask the modes of a tomcat server to the collector
+#Return None if the collector is not available
+def query_collector(socket_path,opts,mode_list):
+    request = {'host':opts.host,'port':opts.port,'url':opts.URL,
+               'modes':mode_list,
+               'options':{'warning':opts.warning,'critical':opts.critical,
+                          'connector':opts.connector,'nameapp':opts.nameapp,
+                          'cache_dir':opts.cache_dir}}
+    try:
+        client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            client.connect(socket_path)
+            client.sendall(json.dumps(request)+"\n")
+            response = json.loads(client.makefile().readline())
+        finally:
+            client.close()
+    except (socket.error,ValueError) as e:
+        if args.verbosity:
+            print "collector %s is not available: %s\n"%(socket_path,e)
+        return None
+    if 'error' in response:
+        return [(mode,'UNKNOWN',response['error'].encode('utf-8'),"") for mode in mode_list]
+    if args.verbosity:
+        print "collected data age: %0.1fs\n"%(response['age'])
+    return [tuple([field.encode('utf-8') for field in result]) for result in response['results']]
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
 
@@ -276,11 +1207,9 @@ parser.add_argument('-v', '--verbosity',action="count",
 conn_parameters = parser.add_argument_group('Connection parameters',
                   'parameters for Tomcat connection')
 conn_parameters.add_argument('-H', '--host',
-                    help="Name or Ip of tomcat host",
-                    required=True)
+                    help="Name or Ip of tomcat host")
 conn_parameters.add_argument('-p','--port',
-                    help="Tomcat port (Example:8080)",
-                    required=True)
+                    help="Tomcat port (Example:8080)")
 conn_parameters.add_argument('-u','--user',
                     default = "admin",
                     help="Tomcat user")
@@ -300,25 +1229,97 @@ conn_parameters.add_argument('-e','--expire_time',
                     default = "0",
                     help='''Expire time for sessions created in tomcat manager app
                     value in minutes (0 minutes by default)''')
+conn_parameters.add_argument('--no-expire',action="store_true",
+                    help='''Do not expire the sessions of tomcat manager app''')
+conn_parameters.add_argument('--expire-every',
+                    default = "1",
+                    help='''Expire the sessions of tomcat manager app once every N
+                    runs (every run by default)''')
+conn_parameters.add_argument('--version-ttl',
+                    default = "86400",
+                    help='''Seconds that the tomcat version and manager layout are
+                    kept in the state file, 0 to read them every run (86400
+                    seconds by default)''')
+conn_parameters.add_argument('--cache-dir',
+                    default = tempfile.gettempdir(),
+                    help='''Directory of the state files kept between runs
+                    (%s by default)'''%(tempfile.gettempdir()))
 
 parameters = parser.add_argument_group('Check parameters',
              'Parameters for tomcat check')
 parameters.add_argument('-n','--nameapp',
                     help="Name of the java application you want to check, only for app mode")
 parameters.add_argument('-w','--warning',
-                    help="Warning value")
+                    help='''Warning value. With several modes, a value by mode
+                    can be defined (example: mem=80,thread=90)''')
 parameters.add_argument('-c','--critical',
-                    help="Critical value")
+                    help='''Critical value. With several modes, a value by mode
+                    can be defined (example: mem=90,thread=95)''')
 parameters.add_argument('-m','--mode',
-                    choices=['status','mem','thread','app'],
-                    help=mode_help,
-                    required=True)
+                    metavar='{'+','.join(modes)+'}',
+                    help=mode_help)
+
+# Passive check results
+passive_parameters = parser.add_argument_group('Passive check parameters',
+                     'Send the result of each mode as a passive check result')
+passive_parameters.add_argument('--passive',action="store_true",
+                    help='''Send a passive check result by mode instead of a
+                    combined output''')
+passive_parameters.add_argument('--passive-host',
+                    help='''Nagios host name of the passive results (tomcat host by
+                    default)''')
+passive_parameters.add_argument('--passive-service',
+                    default = "Tomcat %(mode)s",
+                    help='''Nagios service description of the passive results
+                    ("Tomcat %%(mode)s" by default)''')
+passive_parameters.add_argument('--command-file',
+                    help='''Nagios external command file (example:
+                    /usr/local/nagios/var/rw/nagios.cmd). Results are printed
+                    in standard output if not defined''')
+
+# Collector
+collector_parameters = parser.add_argument_group('Collector parameters',
+                       '''The collector reads the manager pages of the tomcat
+                       servers of an inventory every interval and keeps them in
+                       memory. The checks with --socket are answered by the
+                       collector, without connecting to tomcat''')
+collector_parameters.add_argument('--collector',action="store_true",
+                    help="Run as collector, the tomcat servers are read from --inventory")
+collector_parameters.add_argument('--inventory',
+                    help='''File with a tomcat server by line: "host port [url [user
+                    [password]]]" ("-" for standard input)''')
+collector_parameters.add_argument('--socket',
+                    help='''UNIX socket of the collector. The checks ask the collector
+                    and only connect to tomcat if the collector is not available''')
+collector_parameters.add_argument('--interval',
+                    default = "60",
+                    help="Seconds between collections (60 seconds by default)")
+collector_parameters.add_argument('--ttl',
+                    default = "180",
+                    help='''Seconds that the collected data is valid (180 seconds by
+                    default)''')
+
+# Batch
+batch_parameters = parser.add_argument_group('Batch parameters',
+                   '''Check the modes of all the tomcat servers of --inventory in
+                   one run, several servers at the same time. Also used by the
+                   collector''')
+batch_parameters.add_argument('--batch',action="store_true",
+                    help='''Check all the servers of --inventory, a line by server and
+                    mode is printed (or a passive result with --passive)''')
+batch_parameters.add_argument('--workers',
+                    default = "20",
+                    help="Servers checked at the same time (20 by default)")
+batch_parameters.add_argument('--host-timeout',
+                    default = "15",
+                    help='''Seconds to check a server, after that it is UNKNOWN (15
+                    seconds by default)''')
 
 
 #Corrects negative numbers in arguments parser
 for i, arg in enumerate(sys.argv):
     if arg!="": #prevent an empty character, as ""
-        if (arg[0] == '-') and arg[1].isdigit(): sys.argv[i] = ' ' + arg
+        if (arg[0] == '-') and arg[1:2].isdigit(): sys.argv[i] = ' ' + arg
 # arguments parse
 args = parser.parse_args()
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -349,263 +1350,99 @@ if args.verbosity:
 #Set timeout global
 socket.setdefaulttimeout(float(args.timeout))
 
-#read serviceinfo
-url_serverinfo = args.URL+"/serverinfo"
-page_serverinfo,error_serverinfo = read_page(args.host,args.port,url_serverinfo,args.user,args.authentication)
-if args.verbosity>2:
-    print "serverinfo:"
-    print page_serverinfo
-
-# if error, try the manager/text/serverinfo, because in tomcat 7 change the path
-# of the manager app commands
-if(error_serverinfo):
-    url_serverinfo = args.URL+"/text/serverinfo"
-    page_serverinfo,error_serverinfo = read_page(args.host,args.port,url_serverinfo,args.user,args.authentication)
-# Now it is an error yes or yes
-if(error_serverinfo):
-    output = page_serverinfo
-    exit_status='UNKNOWN'
-if(error_serverinfo==False):
-    # read tomcat version in serverinfo
-    serverinfo = page_serverinfo.splitlines()
-    if args.verbosity>1:
-        print "Server info split: "
-        print serverinfo
-        print ""
-    tomcat_version_string = (serverinfo[1].split(":"))[1]
-    tomcat_status_string = serverinfo[0]
-    if args.verbosity>2:
-        print "tomcat_version_string: "+tomcat_version_string
-        print "tomcat_status_string: "+tomcat_status_string
-    #tomcat version is read in line 2 of serverinfo
-    #example:" Apache Tomcat/7.0.53", choose the "7"
-    tomcat_version = (tomcat_version_string.split("/"))[1].split(".")[0]
-    if args.verbosity:
-        print "tomcat_version: "+tomcat_version
-    #If i can't read the tomcat version because it is not a number
-    if (tomcat_version.isdigit()==False):
-        tomcat_version=0
-        if args.verbosity:
-            print "WARNING: I can't read the tomcat version"
-
-# status option
-#-----------------------------------------------------------------------------
-if args.mode == 'status':
-    #Default state is CRITICAL
-    exit_status='CRITICAL'
-    # If serverinfo page is correct
-    if (error_serverinfo!=True):
-        # check if the first line of serverinfo content "OK"
-        if (tomcat_status_string.find("OK")!=-1):
-            output = tomcat_version_string+" server is OK"
-            exit_status='OK'
-        else:
-            output="This server is not a tomcat server or "+url_serverinfo+" is not the manager app server info page"
-            exit_status='UNKNOWN'
-    # if serverinfo page is not correct try with th status xml page
-    else:
-        tree_xml,error_status_xml = read_page_status_XML(args.host,args.port,args.URL,args.user,args.authentication)
-        #check if page status xml is OK
-        if (error_status_xml!=True):
-            if (tree_xml!=None):
-                if tree_xml.tag=='status':    #The first tag of xml is "status"
-                    output="The Tomcat server is OK, but page serverinfo not work"
-                    exit_status='OK'
-                else:
-                    output="This server is not a tomcat server or not status xml page"
-                    exit_status='UNKNOWN'
-            else:
-                output="I can't read either serviceinfo or serverstatus, this server not seems a Tomcat Server"
-                exit_status='CRITICAL'
-        else:
-            output=tree_xml
-            exit_status='CRITICAL'
-
-
-# mem option
-#-----------------------------------------------------------------------------
-if args.mode == 'mem':
-    # read status xml for extract mem data
-    tree_xml,error_status_xml = read_page_status_XML(args.host,args.port,args.URL,args.user,args.authentication)
-    if error_status_xml:
-        output = tree_xml
-        exit_status = 'WARNING'
-    else:
-        if tree_xml!=None:
-            #control warning and critical values
-            if (args.warning==None) or (args.critical==None):
-                parser.print_usage()
-                parser.exit(status['UNKNOWN'],
-                            'ERROR: Warning and critical values requiered with mode "mem"\n')
-            memory = tree_xml.find('.//memory')
-            free_memory = float(memory.get('free'))
-            total_memory = float(memory.get('total'))
-            max_memory = float(memory.get('max'))
-            available_memory = free_memory + max_memory - total_memory
-            used_memory = max_memory - available_memory
-            percent_used_memory = float((used_memory * 100)/max_memory)
-            if args.verbosity:
-                print "mode: mem(memory)"
-                if args.verbosity > 1:
-                    print "free:%0.1f total:%0.1f max:%0.1f available:%0.1f used:%0.1f percent_used:%0.2f"%(free_memory,
-                                            total_memory,max_memory,available_memory,used_memory,percent_used_memory)
-                print "free_memory:%s total memory:%s max_memory:%s"%(sizeof_fmt(free_memory),sizeof_fmt(total_memory),sizeof_fmt(max_memory))
-                print "available_memory = free_memory + max_memory - total_memory -->  %s" %(sizeof_fmt(available_memory))
-                print "used_memory = max_memory - available_memory -->  %s" %(sizeof_fmt(used_memory))
-                print "percent_used_memory = (used_memory * 100)/max_memory  -->  %0.2f%%\n"%(percent_used_memory)
-
-            #Define status whit function
-            exit_status=define_status(percent_used_memory,args.warning,args.critical)
-            output="Used memory "+sizeof_fmt(used_memory)+" of "+sizeof_fmt(max_memory)+"(%0.2f%%)" %(percent_used_memory)
-            perfdata="'Used_memory'=%0.0f%%;%s;%s"%(percent_used_memory,args.warning,
-                                                        args.critical)
-
-# threads option
-#-----------------------------------------------------------------------------
-if args.mode == 'thread':
-    # read status xml for extract mem data
-    tree_xml,error_status_xml = read_page_status_XML(args.host,args.port,args.URL,args.user,args.authentication)
-    if error_status_xml:
-        output = tree_xml
-        exit_status = 'WARNING'
-    else:
-        if tree_xml!=None:
-            #control warning and critical values
-            if (args.warning==None) or (args.critical==None):
-                parser.print_usage()
-                parser.exit(status['UNKNOWN'],
-                            'ERROR: Warning and critical values of number of threads open is requiered with mode "thread"\n')
-            if(args.connector==None):
-                if (args.verbosity>0): print "Finding all connectors"
-                for connector in tree_xml.findall('./connector'):
-                    connector_name = str(connector.get('name'))
-                    if (args.verbosity>0): print "Find %s connector"%(connector_name)
-                    thread = connector.find('./threadInfo')
-                    max_thread = float(thread.get('maxThreads'))
-                    busy_thread = float(thread.get('currentThreadsBusy'))
-
-                    percent_used_thread = float((busy_thread * 100)/max_thread)
-                    iter_status=define_status(percent_used_thread,args.warning,args.critical)
-
-                    #iter_status=define_status(busy_thread,args.warning,args.critical)
-                    if status[iter_status] > status[exit_status]:
-                            exit_status=iter_status
-                    output = output + '/connector:%s %0.0f threads busy of %0.0f '%(connector_name,busy_thread,max_thread)
-                    perfdata = perfdata + "'conn %s'=%0.0f;%s;%s;0;%0.0f "%(connector_name,busy_thread,args.warning,args.critical,max_thread)
-
-            else:
-                if (args.verbosity>0): print "Finding %s connector"%(args.connector)
-                for connector in tree_xml.findall('./connector'):
-                    connector_name = str(connector.get('name'))
-                    if (args.connector==connector_name):
-                        if (args.verbosity>0):
-                            print "Find %s connector"%(connector_name)
-                        thread = connector.find('./threadInfo')
-                        max_thread = float(thread.get('maxThreads'))
-                        busy_thread = float(thread.get('currentThreadsBusy'))
+if (args.collector or args.batch) and \
+   (not args.workers.isdigit() or int(args.workers)<1):
+    parser.print_usage()
+    parser.exit(status['UNKNOWN'],
+                "ERROR: workers must be a number greater than 0\n")
 
-                        percent_used_thread = float((busy_thread * 100)/max_thread)
-                        exit_status=define_status(percent_used_thread,args.warning,args.critical)
+try:
+    if float(args.version_ttl)<0:
+        raise ValueError
+except ValueError:
+    parser.print_usage()
+    parser.exit(status['UNKNOWN'],
+                "ERROR: version-ttl must be a number of seconds, 0 or greater\n")
 
-                        #exit_status=define_status(busy_thread,args.warning,args.critical)
-                        output = output + 'connector:%s %0.0f threads busy of %0.0f '%(connector_name,busy_thread,max_thread)
-                        perfdata = perfdata + "'conn %s'=%0.0f;%s;%s;0;%0.0f "%(connector_name,busy_thread,args.warning,args.critical,max_thread)
+if not args.expire_every.isdigit() or int(args.expire_every)<1:
+    parser.print_usage()
+    parser.exit(status['UNKNOWN'],
+                "ERROR: expire-every must be a number greater than 0\n")
 
+if args.collector:
+    if (args.inventory==None) or (args.socket==None):
+        parser.print_usage()
+        parser.exit(status['UNKNOWN'],
+                    "ERROR: inventory and socket values requiered with collector\n")
+    run_collector(args)
 
+if args.mode==None:
+    parser.print_usage()
+    parser.exit(status['UNKNOWN'],
+                "ERROR: mode value requiered\n")
 
-# app option
-#-----------------------------------------------------------------------------
-if args.mode == 'app':
-    #Watch if nameapp is defined
-    if args.nameapp==None:
+#Modes to check, separated by commas
+check_list = []
+for mode in args.mode.split(","):
+    mode = mode.strip()
+    if mode not in modes:
         parser.print_usage()
         parser.exit(status['UNKNOWN'],
-                            'ERROR: nameapp value requiered with mode "app"\n')
-    #If serverinfo is not read
-    if error_serverinfo:
-        output="I can't read the serverinfo page. "+page_serverinfo
-        exit_status='UNKNOWN'
-    #If serverinfo is read
-    else:
-        #for versions upper Tomcat 6
-        if (int(tomcat_version) > 6):
-            url_list = args.URL+"/text/list"
-        else:
-            url_list = args.URL+"/list"
-
-        #read application list page
-        page_list,error_list = read_page(args.host,args.port,url_list,args.user,args.authentication)
-        #If list page is not read
-        if error_list:
-            output="I can't read the list page of tomcat manager "+page_list
-            exit_status='UNKNOWN'
-        #If list page is read
-        else:
-            #Divide page_list in lines, each line is an application in the tomcat server
-            applist = page_list.splitlines()
-            if args.verbosity>1:
-                print "page_list split:"
-                print applist
-                print ""
-            #Applications in page list are like "/the_name_of_the_app"
-            matchapp = "/"+args.nameapp
-            match = False     #Flag
-            for application in applist:
-                application = application.split(":")
-                if matchapp == application[0]:
-                    match=True
-                    break
-            #If match app
-            if match:
-                if application[1]=="running":
-                    output = args.nameapp+" is running"
-                    exit_status="OK"
-                elif application[1]=="stopped":
-                    output = args.nameapp+" is stopped"
-                    exit_status="WARNING"
-                else:
-                    output = "I can't understand the state "+application[1]
-                    exit_status="WARNING"
-                #perfdata is the number of sessions for the application
-                perfdata="'sessions'="+application[2]
-            #If not match app
-            else:
-                output = "I can't find the "+matchapp+" application in the tomcat server"
-                exit_status="CRITICAL"
+                    "ERROR: invalid mode '%s' (choose from %s)\n"%(mode,",".join(modes)))
+    if mode not in check_list:
+        check_list.append(mode)
+check_parameters(args,check_list)
 
-#-----------------------------------------------------------------------------
-#-----------------------------------------------------------------------------
-#Expire sessions
+if args.batch:
+    if args.inventory==None:
+        parser.print_usage()
+        parser.exit(status['UNKNOWN'],
+                    "ERROR: inventory value requiered with batch\n")
+    run_batch(args,check_list)
 
-#If serverinfo is read
-if not error_serverinfo:
-    if (int(tomcat_version) > 6):
-        url_expire = args.URL+"/text/expire?path="+args.URL+"&idle="+args.expire_time
-    else:
-        url_expire = args.URL+"/expire?path="+args.URL+"&idle="+args.expire_time
-    #for versions upper Tomcat 6
-    #Expire sessions of manager app
-    page_expire,error_expire = read_page(args.host,args.port,url_expire,args.user,args.authentication)
-if (args.verbosity>0):
-    if not error_expire:
-        print("Expire sessions of "+args.URL)
-    if (args.verbosity>1):
-        print("Expire information:")
-        print(page_expire)
+if (args.host==None) or (args.port==None):
+    parser.print_usage()
+    parser.exit(status['UNKNOWN'],
+                "ERROR: host and port values requiered\n")
 
+results = None
+if args.socket:
+    results = query_collector(args.socket,args,check_list)
+if results==None:
+    manager = new_manager(args.host,args.port,args.URL,args.user,args.authentication,args)
+    results = check_modes(manager,args,check_list)
 
+    #-------------------------------------------------------------------------
+    #Expire sessions
+    expire_sessions(manager,args)
+    if args.verbosity>1:
+        http_pool.print_stats()
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 #Outputs
 
-if output=='':
-    output = "ERROR: no output"
-    exit_status ='UNKNOWN'
+if args.passive:
+    passive_host = args.passive_host
+    if passive_host==None:
+        passive_host = args.host
+    try:
+        passive_lines = send_passive_results(results,passive_host,args.passive_service,args.command_file)
+    except (IOError,OSError) as e:
+        print "UNKNOWN ERROR: I can't write the passive results. %s"%(e)
+        sys.exit(status['UNKNOWN'])
+    exit_status = 'OK'
+    output = "%i passive results sent (%s)"%(len(results),
+             " ".join(["%s:%s"%(result[0],result[1]) for result in results]))
+else:
+    exit_status,output,perfdata = combine_results(results)
+
 message = exit_status + " " + output
 if perfdata!="":
     message = message + '|' + perfdata
 if longoutput!="":
     message = message + longoutput
 print message
-sys.exit(status[exit_status]) 
+if args.passive and passive_lines!="":
+    sys.stdout.write(passive_lines)
+sys.exit(status[exit_status])
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+#
+# Nagios plugin state store
+#
+# Shared by the python plugins of this repository, copy it in the same
+# directory as the plugins that import it.
+#
+# Keeps numeric samples between runs of a plugin, so counters can be reported
+# as rates, derivatives or moving averages without an external database.
+# Each key (a check, a connector, a metric...) has a short series of samples,
+# every sample is a timestamp and a set of float fields.
+#
+# The store is a compact binary file:
+#   "NGST" version(1 byte) keys(uint32)
+#   for each key: name(uint16 length + utf-8) fields(uint8) field names(uint8
+#   length + utf-8 each) samples(uint16) and for each sample the timestamp and
+#   the field values as doubles
+#
+# Writes are atomic (temporary file, fsync and rename) and the store is locked
+# while it is used, so a crash or two plugins running at the same time never
+# leave a half written file. A damaged file is discarded and starts empty.
+#
+# Usage:
+#   with StateStore('/var/tmp/check_x.state') as store:
+#       rates = store.rate('requests', {'count': 1234})
+#       store.add('requests', {'count': 1234})
+#
+
+import os
+import struct
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAGIC = b'NGST'
+FORMAT_VERSION = 1
+NAN = float('nan')
+
+def _text(name):
+    # Keys and field names are unicode, byte strings (python 2 str) are utf-8
+    if isinstance(name, bytes):
+        return name.decode('utf-8', 'replace')
+    return name
+
+class StateStore(object):
+
+    def __init__(self, path, max_samples=10, max_age=7 * 86400, max_keys=None):
+        # max_samples: samples kept by key, the oldest are dropped
+        # max_age: seconds since the last sample after which a key is dropped
+        # max_keys: keys kept, the least recently updated are dropped
+        self.path = path
+        self.max_samples = max_samples
+        self.max_age = max_age
+        self.max_keys = max_keys
+        self.data = {}          # key -> (field names, [(timestamp, values)])
+        self.changed = False
+        self.lock_file = None
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Open and close
+    #
+    def __enter__(self):
+        self.lock()
+        self.load()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and self.changed:
+                self.save()
+        finally:
+            self.unlock()
+        return False
+
+    def lock(self):
+        if fcntl is None:
+            return
+        self.lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+
+    def unlock(self):
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def load(self):
+        self.data = {}
+        self.changed = False
+        try:
+            with open(self.path, 'rb') as state_file:
+                buf = state_file.read()
+        except (IOError, OSError):
+            return
+        try:
+            self.data = self._decode(buf)
+        except (struct.error, ValueError, UnicodeDecodeError):
+            self.data = {}
+
+    def save(self):
+        now = time.time()
+        for key in list(self.data.keys()):
+            fields, samples = self.data[key]
+            if not samples or now - samples[-1][0] > self.max_age:
+                del self.data[key]
+        if self.max_keys is not None and len(self.data) > self.max_keys:
+            recent = sorted(self.data.keys(), key=lambda key: self.data[key][1][-1][0], reverse=True)
+            for key in recent[self.max_keys:]:
+                del self.data[key]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix='.state', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(self._encode(self.data))
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.rename(temp_path, self.path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.changed = False
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Binary format
+    #
+    @staticmethod
+    def _encode(data):
+        parts = [MAGIC, struct.pack('<BI', FORMAT_VERSION, len(data))]
+        for key in sorted(data.keys()):
+            fields, samples = data[key]
+            name = key.encode('utf-8')
+            parts.append(struct.pack('<H', len(name)) + name)
+            parts.append(struct.pack('<B', len(fields)))
+            for field in fields:
+                field_name = field.encode('utf-8')
+                parts.append(struct.pack('<B', len(field_name)) + field_name)
+            parts.append(struct.pack('<H', len(samples)))
+            row = struct.Struct('<%id' % (len(fields) + 1))
+            for timestamp, values in samples:
+                parts.append(row.pack(timestamp, *values))
+        return b''.join(parts)
+
+    @staticmethod
+    def _decode(buf):
+        if buf[:4] != MAGIC:
+            raise ValueError("not a state file")
+        version, count = struct.unpack_from('<BI', buf, 4)
+        if version != FORMAT_VERSION:
+            raise ValueError("unknown state file version %i" % version)
+        offset = 9
+        data = {}
+        for i in range(count):
+            (length,) = struct.unpack_from('<H', buf, offset)
+            key = buf[offset + 2:offset + 2 + length].decode('utf-8')
+            offset = offset + 2 + length
+            (field_count,) = struct.unpack_from('<B', buf, offset)
+            offset = offset + 1
+            fields = []
+            for j in range(field_count):
+                (length,) = struct.unpack_from('<B', buf, offset)
+                fields.append(buf[offset + 1:offset + 1 + length].decode('utf-8'))
+                offset = offset + 1 + length
+            (sample_count,) = struct.unpack_from('<H', buf, offset)
+            offset = offset + 2
+            row = struct.Struct('<%id' % (field_count + 1))
+            samples = []
+            for j in range(sample_count):
+                values = row.unpack_from(buf, offset)
+                samples.append((values[0], values[1:]))
+                offset = offset + row.size
+            data[key] = (tuple(fields), samples)
+        return data
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Samples
+    #
+    def keys(self):
+        return list(self.data.keys())
+
+    def samples(self, key):
+        # All the samples of a key, oldest first: [(timestamp, {field: value})]
+        key = _text(key)
+        if key not in self.data:
+            return []
+        fields, samples = self.data[key]
+        return [(timestamp, dict(zip(fields, values))) for timestamp, values in samples]
+
+    def last(self, key):
+        # Last sample of a key: (timestamp, {field: value}), None if empty
+        key = _text(key)
+        if key not in self.data or not self.data[key][1]:
+            return None
+        fields, samples = self.data[key]
+        timestamp, values = samples[-1]
+        return timestamp, dict(zip(fields, values))
+
+    def add(self, key, values, timestamp=None):
+        # Append a sample to a key, keeping the last max_samples samples
+        # A sample with other fields than the stored ones starts a new series
+        if timestamp is None:
+            timestamp = time.time()
+        key = _text(key)
+        values = dict([(_text(field), value) for field, value in values.items()])
+        fields = tuple(sorted(values.keys()))
+        row = tuple([float(NAN if values[field] is None else values[field]) for field in fields])
+        if key in self.data and self.data[key][0] == fields:
+            samples = self.data[key][1]
+        else:
+            samples = []
+            self.data[key] = (fields, samples)
+        samples.append((float(timestamp), row))
+        del samples[:-self.max_samples]
+        self.changed = True
+
+    def set(self, key, values, timestamp=None):
+        # Replace the samples of a key with a single sample
+        self.delete(key)
+        self.add(key, values, timestamp)
+
+    def delete(self, key):
+        key = _text(key)
+        if key in self.data:
+            del self.data[key]
+            self.changed = True
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Rates and averages
+    #
+    def rate(self, key, values, timestamp=None):
+        # Per second change of each field since the last sample of the key
+        # Return None without a previous sample, or if a counter went back (the
+        # monitored service was restarted). The new sample is not added.
+        if timestamp is None:
+            timestamp = time.time()
+        last = self.last(key)
+        if last is None:
+            return None
+        elapsed = timestamp - last[0]
+        if elapsed <= 0:
+            return None
+        rates = {}
+        for field, value in values.items():
+            field = _text(field)
+            if field not in last[1]:
+                return None
+            delta = float(value) - last[1][field]
+            if delta < 0:
+                return None
+            rates[field] = delta / elapsed
+        return rates
+
+    def derivative(self, key, field):
+        # Per second change of a field between the first and last stored sample
+        samples = self.samples(key)
+        field = _text(field)
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
+            return None
+        return (samples[-1][1][field] - samples[0][1][field]) / (samples[-1][0] - samples[0][0])
+
+    def average(self, key, field, count=None):
+        # Moving average of a field over the last count samples (all by default)
+        field = _text(field)
+        values = [sample[field] for timestamp, sample in self.samples(key)[-(count or self.max_samples):]
+                  if field in sample and sample[field] == sample[field]]
+        if not values:
+            return None
+        return sum(values) / len(values)
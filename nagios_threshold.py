@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+#
+# Nagios threshold ranges
+#
+# Shared by the python plugins of this repository, copy it in the same
+# directory as the plugins that import it.
+#
+# The warning and critical values are compiled once in a Threshold object,
+# and then any number of values can be evaluated against it.
+#
+# Range format (https://nagios-plugins.org/doc/guidelines.html#THRESHOLDFORMAT):
+#   10      alert if value < 0 or > 10
+#   10:     alert if value < 10
+#   ~:10    alert if value > 10
+#   10:20   alert if value < 10 or > 20
+#   @10:20  alert if value >= 10 and <= 20
+#
+
+from collections import namedtuple
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Nagios return codes
+#
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_CRITICAL = 2
+STATE_UNKNOWN = 3
+STATE_NAMES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+INFINITY = float('inf')
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Ranges
+#
+class ThresholdError(ValueError):
+    pass
+
+class Range(namedtuple('Range', ['start', 'end', 'inside', 'text'])):
+    # A range is immutable: start and end are floats (maybe infinite), inside is
+    # True if the alert is inside the range (@) and text is the original string
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, text):
+        text = str(text).strip()
+        value = text
+        inside = value.startswith('@')
+        if inside:
+            value = value[1:]
+        if ':' in value:
+            start, end = value.split(':', 1)
+        else:
+            start, end = '0', value
+        try:
+            if start == '~':
+                start = -INFINITY
+            else:
+                start = float(start or 0)
+            if end == '':
+                end = INFINITY
+            else:
+                end = float(end)
+        except ValueError:
+            raise ThresholdError("Bad range definition: " + text)
+        if start > end:
+            raise ThresholdError("Second value of range " + text + " is less than first value")
+        return cls(start, end, inside, text)
+
+    def alert(self, value):
+        if self.inside:
+            return self.start <= value <= self.end
+        return value < self.start or value > self.end
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Thresholds
+#
+class Threshold(object):
+    # Warning and critical ranges compiled once, both are optional
+    __slots__ = ('warning', 'critical')
+
+    def __init__(self, warning=None, critical=None):
+        object.__setattr__(self, 'warning', self._range(warning))
+        object.__setattr__(self, 'critical', self._range(critical))
+
+    @staticmethod
+    def _range(text):
+        if text is None or isinstance(text, Range):
+            return text
+        return Range.parse(text)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Threshold objects are immutable")
+
+    def __repr__(self):
+        return "Threshold(warning=%r, critical=%r)" % (self.warning and self.warning.text, self.critical and self.critical.text)
+
+    def status(self, value):
+        # Nagios state of a value: STATE_OK, STATE_WARNING or STATE_CRITICAL
+        value = float(value)
+        if self.critical is not None and self.critical.alert(value):
+            return STATE_CRITICAL
+        if self.warning is not None and self.warning.alert(value):
+            return STATE_WARNING
+        return STATE_OK
+
+    def statuses(self, values):
+        # Nagios state of each value of a list, in the same order
+        critical = self.critical
+        warning = self.warning
+        result = []
+        append = result.append
+        for value in values:
+            value = float(value)
+            if critical is not None and critical.alert(value):
+                append(STATE_CRITICAL)
+            elif warning is not None and warning.alert(value):
+                append(STATE_WARNING)
+            else:
+                append(STATE_OK)
+        return result
+
+    def worst(self, values):
+        # Worst Nagios state of a list of values (STATE_OK for an empty list)
+        return max([STATE_OK] + self.statuses(values))
+
+    def perfdata(self):
+        # Warning and critical fields of a performance data value: "w;c"
+        return "%s;%s" % (self.warning.text if self.warning else '', self.critical.text if self.critical else '')
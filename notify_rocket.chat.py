@@ -5,9 +5,27 @@
 # Notify Rocket.Chat
 #
 
-import argparse, sys
+import argparse, sys, os, time, fcntl, socket, threading
 import requests
 import json
+from collections import deque
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+from nagios_state import StateStore
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Nagios return codes
+#
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_CRITICAL = 2
+STATE_UNKNOWN = 3
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Plugin info
@@ -41,8 +59,7 @@ parser.add_argument('-v','--version', action='version',
     help="Show plugin version",
     version='%(prog)s ' + PLUGIN_VERSION)
 parser.add_argument('--url',
-    help='Rocket.Chat Webhook URL',
-    required=True)
+    help='Rocket.Chat Webhook URL')
 parser.add_argument('--channel',
     help='Channel to post the message. Default: "alerts"',
     default='#alerts')
@@ -52,11 +69,9 @@ group.add_argument('--host-notification', action="store_true",
 group.add_argument('--service-notification', action="store_true",
     help='Notify a service problem')
 parser.add_argument('--notificationtype',
-    help='Use with macro $NOTIFICATIONTYPE$: ["PROBLEM", "RECOVERY", "ACKNOWLEDGEMENT", "FLAPPINGSTART", "FLAPPINGSTOP", "FLAPPINGDISABLED", "DOWNTIMESTART", "DOWNTIMEEND", "DOWNTIMECANCELLED"]',
-    required=True)
+    help='Use with macro $NOTIFICATIONTYPE$: ["PROBLEM", "RECOVERY", "ACKNOWLEDGEMENT", "FLAPPINGSTART", "FLAPPINGSTOP", "FLAPPINGDISABLED", "DOWNTIMESTART", "DOWNTIMEEND", "DOWNTIMECANCELLED"]')
 parser.add_argument('--hostname',
-    help='Use with macro $HOSTNAME$',
-    required=True)
+    help='Use with macro $HOSTNAME$')
 parser.add_argument('--hostalias',
     help='Use with macro $HOSTALIAS$')
 parser.add_argument('--hostaddress',
@@ -75,11 +90,76 @@ parser.add_argument('--serviceoutput',
     help='Use with macro $SERVICEOUTPUT$')
 parser.add_argument('--serviceduration',
     help='Use with macro $SERVICEDURATION$: Format is "XXh YYm ZZs", indicating hours, minutes and seconds.')
+parser.add_argument('--timeout',
+    help='Value, in seconds, to send a message to Rocket.Chat. Default: 10',
+    type=float,
+    default=10.0)
 parser.add_argument("--verbose-mode", action="store_true",
     help="Increase output verbosity")
+spool_parameters = parser.add_argument_group('Spool parameters', 'Keep the notifications in a local spool and send them later merged by host')
+spool_parameters.add_argument('--spool',
+    help='Spool directory. The notification is only written in it, and --flush sends it')
+spool_parameters.add_argument('--flush', action="store_true",
+    help='Send the notifications of the spool, one message by host with the notifications as attachments')
+spool_parameters.add_argument('--flush-interval',
+    help='Value, in seconds, between flushes of the spool. Default: 0, flush once and exit',
+    type=int,
+    default=0)
+spool_parameters.add_argument('--max-attachments',
+    help='Maximum number of notifications merged in a message. Default: 20',
+    type=int,
+    default=20)
+spool_parameters.add_argument('--retries',
+    help='Number of retries of a message, waiting 1, 2, 4... seconds. Default: 3',
+    type=int,
+    default=3)
+spool_parameters.add_argument('--max-age',
+    help='Value, in seconds, after which a notification that could not be sent is dropped. Default: 86400',
+    type=int,
+    default=86400)
+sender_parameters = parser.add_argument_group('Sender parameters', 'Hand the notification to a local sender process and exit without waiting for Rocket.Chat')
+sender_parameters.add_argument('--socket',
+    help='UNIX socket of the sender. The notification is handed to the sender, or sent as usual if it is not running')
+sender_parameters.add_argument('--sender', action="store_true",
+    help='Run the sender process, listening in --socket')
+sender_parameters.add_argument('--senders',
+    help='Number of messages the sender sends at the same time. Default: 4',
+    type=int,
+    default=4)
+sender_parameters.add_argument('--queue-size',
+    help='Maximum number of messages waiting in the sender, the next ones are refused. Default: 1000',
+    type=int,
+    default=1000)
+sender_parameters.add_argument('--sender-status', action="store_true",
+    help='Check the sender: queue depth, messages sent and failed and send latency')
+sender_parameters.add_argument('--status-window',
+    help='Value, in seconds, in which a failed or refused message makes --sender-status WARNING. Default: 900',
+    type=int,
+    default=900)
+dedup_parameters = parser.add_argument_group('Deduplication parameters', 'Collapse the notifications repeated for the same host, service and state, and the changes of state of a flapping host or service')
+dedup_parameters.add_argument('--dedup-file',
+    help='Index of the last notification sent by host and service. A notification with the same type and state as the last one sent within --dedup-window is not sent, and the next one sent tells how many times it was repeated')
+dedup_parameters.add_argument('--dedup-window',
+    help='Value, in seconds, after sending a notification in which its repetitions are not sent. Default: 300',
+    type=int,
+    default=300)
+dedup_parameters.add_argument('--dedup-size',
+    help='Maximum number of hosts and services in the index, the least recently notified are dropped. Default: 10000',
+    type=int,
+    default=10000)
+dedup_parameters.add_argument('--flap-changes',
+    help='Changes of state of a host or service within --dedup-window after which it is flapping: the next changes are held in --spool, and --flush sends only the last one with the number of changes. 0 to disable. Default: 4',
+    type=int,
+    default=4)
 # Parse arguments:
 args = parser.parse_args()
 printVerbose(args)
+if args.flush and not args.spool:
+    parser.error("--flush requires --spool")
+if (args.sender or args.sender_status) and not args.socket:
+    parser.error("--sender and --sender-status require --socket")
+if not (args.flush or args.sender or args.sender_status) and not (args.url and args.notificationtype and args.hostname):
+    parser.error("--url, --notificationtype and --hostname are required")
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Nagios variables:
@@ -163,16 +243,472 @@ def getServicePayload():
     }
     return payload
 
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Deduplication
+#
+# The index keeps by host and service the last notification handed over
+# (its type and state), when it was handed over, how many repetitions of it
+# were suppressed and when the last one not held for flapping was handed
+# over, and the times of its last changes of state. A repetition within
+# --dedup-window is suppressed, and the next notification tells how many
+# there were. A change of state is never suppressed: when there are
+# --flap-changes or more within the window, it is held in the spool and the
+# flusher sends only the last state held, with the number of changes.
+# Acknowledgements and downtimes are always sent and do not change the index.
+DEDUP_TYPES = ["PROBLEM", "RECOVERY", "FLAPPINGSTART", "FLAPPINGSTOP"]
+DEDUP_STATES = ["UP", "DOWN", "UNREACHABLE", "OK", "WARNING", "UNKNOWN", "CRITICAL"]
+DEDUP_SAMPLES = 100     # changes of state kept by host and service
+
+def formatSpan(seconds):
+    if seconds < 60:
+        return "%is" % seconds
+    return "%im" % round(seconds / 60.0)
+
+def dedupStore(path):
+    # The last notification and the changes are two keys by host and service
+    return StateStore(path, max_samples=DEDUP_SAMPLES, max_keys=2 * args.dedup_size)
+
+def dedupKey():
+    if args.service_notification:
+        return "\t".join([args.hostname, args.servicedesc or ""])
+    return args.hostname
+
+def dedupState():
+    # Type and state of the notification, as numbers for the index
+    state = args.servicestate if args.service_notification else args.hoststate
+    if state not in DEDUP_STATES:
+        return DEDUP_TYPES.index(args.notificationtype), -1
+    return DEDUP_TYPES.index(args.notificationtype), DEDUP_STATES.index(state)
+
+def dedupPayload(payload):
+    # Return (payload, flapping): payload is None if it repeats the last
+    # notification within --dedup-window, flapping is None or the values kept
+    # with the notification held in the spool
+    if args.notificationtype not in DEDUP_TYPES:
+        return payload, None
+    notification_type, state = dedupState()
+    now = time.time()
+    key = dedupKey()
+    with dedupStore(args.dedup_file) as store:
+        last = store.last(key)
+        if last is not None:
+            timestamp, values = last
+        if last is not None and values["type"] == notification_type and values["state"] == state:
+            if now - values["sent"] < args.dedup_window:
+                values["count"] = values["count"] + 1
+                store.set(key, values, now)
+                return None, None
+        else:
+            store.add("changes " + key, {"state": state}, now)
+        changes = [moment for moment, sample in store.samples("changes " + key) if now - moment < args.dedup_window]
+    if last is not None and values["count"]:
+        payload = dict(payload)
+        payload["text"] = payload["text"] + " (la notificación anterior se repitió {count} veces en {span})".format(
+            count=int(values["count"]), span=formatSpan(timestamp - values["sent"]))
+    if not args.spool or args.flap_changes <= 0 or len(changes) < args.flap_changes:
+        return payload, None
+    return payload, {"index": os.path.abspath(args.dedup_file), "key": key, "changes": len(changes), "since": changes[0]}
+
+def dedupSent(held=False):
+    # Record the notification as the last one handed over, once it was handed
+    # to the sender, spooled, posted or held for flapping
+    if not args.dedup_file or args.notificationtype not in DEDUP_TYPES:
+        return
+    notification_type, state = dedupState()
+    now = time.time()
+    try:
+        with dedupStore(args.dedup_file) as store:
+            last = store.last(dedupKey())
+            direct = now
+            if held:
+                direct = last[1]["direct"] if last is not None and "direct" in last[1] else 0
+            store.set(dedupKey(), {"type": notification_type, "state": state, "sent": now, "count": 0, "direct": direct}, now)
+    except (IOError, OSError, ValueError):
+        printVerbose(sys.exc_info())
+
+def collapseFlapping(entries):
+    # Keep of the notifications held for flapping only the last one of each
+    # host and service, with the number of changes, and drop it if a newer
+    # notification was handed over without holding it
+    held = {}
+    for path, notification in entries:
+        if notification.get("flap"):
+            flap = notification["flap"]
+            held.setdefault((notification["url"], flap["key"]), []).append((path, notification))
+    result = []
+    for path, notification in entries:
+        if not notification.get("flap"):
+            result.append((path, notification))
+            continue
+        flap = notification["flap"]
+        group = held[(notification["url"], flap["key"])]
+        if group[-1][0] != path:
+            printVerbose("SPOOL: " + path + " flapping, replaced by a newer state")
+            os.remove(path)
+            continue
+        try:
+            with dedupStore(flap["index"]) as store:
+                last = store.last(flap["key"])
+        except (IOError, OSError, ValueError):
+            printVerbose(sys.exc_info())
+            last = None
+        if last is not None and last[1].get("direct", 0) > notification["time"]:
+            printVerbose("SPOOL: " + path + " flapping, a newer state was sent")
+            os.remove(path)
+            continue
+        notification["payload"]["text"] = notification["payload"]["text"] + " (flapping: {changes} cambios de estado en {span})".format(
+            changes=flap["changes"], span=formatSpan(notification["time"] - flap["since"]))
+        result.append((path, notification))
+    return result
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Spool
+#
+# Each notification is a file of the spool directory: {"url", "time", "payload"}
+# and "flap" if it is held for flapping (see collapseFlapping()).
+# It is written with a name starting with "." and renamed, so the flusher
+# never reads a half written notification.
+def spoolPayload(url, payload, flap=None):
+    name = "%.6f-%i.json" % (time.time(), os.getpid())
+    temp_path = os.path.join(args.spool, "." + name)
+    notification = {"url": url, "time": time.time(), "payload": payload}
+    if flap:
+        notification["flap"] = flap
+    with open(temp_path, 'w') as spool_file:
+        json.dump(notification, spool_file)
+    os.rename(temp_path, os.path.join(args.spool, name))
+    return name
+
+def validNotification(notification):
+    # A spooled notification has the keys used by flushSpool()
+    return (isinstance(notification, dict) and isinstance(notification.get("time"), (int, float))
+            and notification.get("url") and isinstance(notification.get("payload"), dict)
+            and "channel" in notification["payload"] and "alias" in notification["payload"]
+            and (not notification.get("flap") or isinstance(notification["flap"], dict)
+                 and all([field in notification["flap"] for field in ["index", "key", "changes", "since"]])))
+
+def readSpool():
+    # Notifications of the spool, oldest first: [(file path, notification)]
+    # A file that is not a notification is renamed to .bad and skipped
+    entries = []
+    for name in sorted(os.listdir(args.spool)):
+        if name.startswith(".") or not name.endswith(".json"):
+            continue
+        path = os.path.join(args.spool, name)
+        try:
+            with open(path) as spool_file:
+                notification = json.load(spool_file)
+        except ValueError:
+            notification = None
+        except (IOError, OSError):
+            printVerbose(sys.exc_info())
+            continue
+        if validNotification(notification):
+            entries.append((path, notification))
+            continue
+        print("SPOOL: " + name + " is not a notification, renamed to " + name + ".bad")
+        try:
+            os.rename(path, path + ".bad")
+        except (IOError, OSError):
+            printVerbose(sys.exc_info())
+    return entries
+
+def mergePayloads(payloads):
+    # One message with the attachments of all the notifications, the text of
+    # each notification is the title of its attachments
+    if len(payloads) == 1:
+        return payloads[0]
+    attachments = []
+    for payload in payloads:
+        for attachment in payload.get("attachments", []):
+            attachment = dict(attachment)
+            attachment["title"] = payload["text"]
+            attachments.append(attachment)
+    return {
+        "channel": payloads[-1]["channel"],
+        "alias": payloads[-1]["alias"],
+        "emoji": payloads[-1]["emoji"],
+        "text": "*{count} notificaciones* de *{alias}*".format(count=len(payloads), alias=payloads[-1]["alias"]),
+        "attachments": attachments
+    }
+
+# Results of postPayload():
+POST_SENT = "sent"
+POST_REJECTED = "rejected"      # the message is wrong, it is never retried
+POST_FAILED = "failed"          # the server could not be reached, it can be retried
+
+def postPayload(session, url, payload):
+    # Send a message, retrying with backoff if the server fails or limits the
+    # rate. Return POST_SENT, POST_REJECTED or POST_FAILED
+    data = json.dumps(payload)
+    printVerbose(data)
+    for retry in range(args.retries + 1):
+        if retry:
+            wait = 2 ** (retry - 1)
+            printVerbose("RETRY " + str(retry) + " in " + str(wait) + "s")
+            time.sleep(wait)
+        try:
+            response = session.post(url, data = data, timeout = args.timeout)
+        except requests.exceptions.RequestException:
+            printVerbose(sys.exc_info())
+            continue
+        printVerbose(response.text)
+        if response.status_code < 300:
+            return POST_SENT
+        if response.status_code != 429 and response.status_code < 500:
+            # The message is wrong, it will never be accepted
+            print("ERROR - Rocket.Chat rejected the message: " + response.text)
+            return POST_REJECTED
+        if response.status_code == 429 and response.headers.get("Retry-After", "").isdigit():
+            time.sleep(int(response.headers["Retry-After"]))
+    return POST_FAILED
+
+def flushSpool(session):
+    # Send the notifications of the spool merged by webhook, channel and host
+    groups = {}
+    order = []
+    for path, notification in collapseFlapping(readSpool()):
+        if time.time() - notification["time"] > args.max_age:
+            printVerbose("SPOOL: " + path + " too old, dropped")
+            os.remove(path)
+            continue
+        payload = notification["payload"]
+        key = (notification["url"], payload["channel"], payload["alias"])
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append((path, payload))
+    sent = 0
+    failed = 0
+    for key in order:
+        entries = groups[key]
+        for start in range(0, len(entries), args.max_attachments):
+            chunk = entries[start:start + args.max_attachments]
+            result = postPayload(session, key[0], mergePayloads([payload for path, payload in chunk]))
+            if result == POST_SENT:
+                sent = sent + len(chunk)
+            else:
+                failed = failed + len(chunk)
+            if result != POST_FAILED:
+                # Sent or rejected, a rejected message is never accepted
+                for path, payload in chunk:
+                    os.remove(path)
+    return sent, failed
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Sender
+#
+# The sender keeps a bounded queue of messages and a pool of threads sending
+# them over a shared session. Each request is a json line: a message
+# {"url", "payload"}, answered "OK" or "FULL", or {"command": "status",
+# "window": seconds}, answered with the metrics of the sender and the failed
+# and refused messages in the last window seconds.
+class SenderMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.refused = 0
+        self.latencies = deque(maxlen=100)    # seconds of the last messages
+        self.failures = deque(maxlen=1000)    # times of the last failed messages
+        self.refusals = deque(maxlen=1000)    # times of the last refused messages
+
+    def record(self, result, latency):
+        # Rejected messages are counted as failed
+        with self.lock:
+            if result == POST_SENT:
+                self.sent = self.sent + 1
+            else:
+                self.failed = self.failed + 1
+                self.failures.append(time.time())
+            self.latencies.append(latency)
+
+    def refuse(self):
+        with self.lock:
+            self.refused = self.refused + 1
+            self.refusals.append(time.time())
+
+    def status(self, pending, window):
+        since = time.time() - window
+        with self.lock:
+            latencies = list(self.latencies)
+            recent_failed = len([moment for moment in self.failures if moment >= since])
+            recent_refused = len([moment for moment in self.refusals if moment >= since])
+        average = 0
+        if latencies:
+            average = sum(latencies) / len(latencies)
+        return {"queue": pending.qsize(), "queue_size": args.queue_size, "sent": self.sent, "failed": self.failed,
+                "refused": self.refused, "latency": average, "latency_max": max(latencies or [0]),
+                "window": window, "recent_failed": recent_failed, "recent_refused": recent_refused}
+
+def senderWorker(session, pending, metrics):
+    while True:
+        url, payload = pending.get()
+        start = time.time()
+        try:
+            result = postPayload(session, url, payload)
+        except Exception:
+            printVerbose(sys.exc_info())
+            result = POST_FAILED
+        metrics.record(result, time.time() - start)
+
+class SenderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            request = None
+        if not isinstance(request, dict) or not (request.get("command") == "status" or ("url" in request and "payload" in request)):
+            self.wfile.write("ERROR not a message or a command\n".encode('utf-8'))
+            return
+        if request.get("command") == "status":
+            window = request.get("window")
+            if not isinstance(window, (int, float)):
+                window = args.status_window
+            answer = json.dumps(self.server.metrics.status(self.server.pending, window))
+        else:
+            try:
+                self.server.pending.put_nowait((request["url"], request["payload"]))
+                answer = "OK"
+            except queue.Full:
+                self.server.metrics.refuse()
+                answer = "FULL"
+        self.wfile.write((answer + "\n").encode('utf-8'))
+
+class SenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def runSender():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.senders)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = SenderServer(args.socket, SenderHandler)
+    server.pending = queue.Queue(args.queue_size)
+    server.metrics = SenderMetrics()
+    for i in range(args.senders):
+        thread = threading.Thread(target=senderWorker, args=(session, server.pending, server.metrics))
+        thread.daemon = True
+        thread.start()
+    print("Sender listening in " + args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(args.socket)
+
+def senderRequest(request):
+    # Send a request to the sender and return its answer
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(2)
+    try:
+        client.connect(args.socket)
+        client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        return client.makefile('r').readline().strip()
+    finally:
+        client.close()
+
+def checkSender():
+    # Nagios check of the sender: WARNING with the queue half full or failed
+    # or refused messages in the last --status-window seconds, CRITICAL if it
+    # is not running or the queue is full
+    try:
+        status = json.loads(senderRequest({"command": "status", "window": args.status_window}))
+    except (socket.error, ValueError):
+        printVerbose(sys.exc_info())
+        return STATE_CRITICAL, "CRITICAL - El sender de Rocket.Chat no responde en " + args.socket
+    exit_status = STATE_OK
+    if status["queue"] >= status["queue_size"]:
+        exit_status = STATE_CRITICAL
+    elif status["queue"] * 2 >= status["queue_size"] or status["recent_failed"] or status["recent_refused"]:
+        exit_status = STATE_WARNING
+    text = ["OK", "WARNING", "CRITICAL"][exit_status] + " - Sender de Rocket.Chat: {queue}/{queue_size} en cola, {sent} enviados, {failed} fallidos, {refused} rechazados ({recent_failed} fallidos y {recent_refused} rechazados en los últimos {window}s), latencia {latency:.3f}s".format(**status)
+    performance = "queue={queue};;;0;{queue_size} sent={sent}c failed={failed}c refused={refused}c latency={latency:.3f}s latency_max={latency_max:.3f}s".format(**status)
+    return exit_status, text + " | " + performance
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Send notification
 #
+if args.sender:
+    runSender()
+    sys.exit(0)
+if args.sender_status:
+    exit_status, text = checkSender()
+    print(text)
+    sys.exit(exit_status)
+if args.flush:
+    # Only one flusher at a time:
+    lock_file = open(os.path.join(args.spool, ".flush.lock"), 'a')
+    try:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        print("OK - Another flush of " + args.spool + " is running")
+        sys.exit(0)
+    session = requests.Session()
+    while True:
+        sent, failed = flushSpool(session)
+        if sent or failed or not args.flush_interval:
+            print("Notifications sent: " + str(sent) + ", failed: " + str(failed))
+        if not args.flush_interval:
+            break
+        time.sleep(args.flush_interval)
+    sys.exit(0)
 if args.host_notification:
     payload = getHostPayload()
 elif args.service_notification:
     payload = getServicePayload()
 else:
     print("ERROR - Must select --host-notification or --service-notification")
+    sys.exit(1)
+flap = None
+if args.dedup_file:
+    try:
+        payload, flap = dedupPayload(payload)
+    except (IOError, OSError, ValueError):
+        # Without the index the notification is sent
+        printVerbose(sys.exc_info())
+    if payload is None:
+        print("Notification suppressed, repeated within " + formatSpan(args.dedup_window))
+        sys.exit(0)
+if flap:
+    try:
+        printVerbose(json.dumps(payload))
+        print("Notification held in the spool, flapping: " + spoolPayload(args.url, payload, flap))
+        dedupSent(held=True)
+        sys.exit(0)
+    except (IOError, OSError):
+        # Without the spool the notification is sent now
+        printVerbose(sys.exc_info())
+if args.socket:
+    try:
+        printVerbose(json.dumps(payload))
+        answer = senderRequest({"url": args.url, "payload": payload})
+        if answer == "OK":
+            dedupSent()
+            print("Notification queued in the sender")
+            sys.exit(0)
+        printVerbose("SENDER: " + answer)
+    except socket.error:
+        # Without the sender the notification is spooled or sent now
+        printVerbose(sys.exc_info())
+if args.spool:
+    try:
+        printVerbose(json.dumps(payload))
+        print("Notification spooled: " + spoolPayload(args.url, payload))
+        dedupSent()
+        sys.exit(0)
+    except (IOError, OSError):
+        # Without the spool the notification is sent now
+        printVerbose(sys.exc_info())
 data = json.dumps(payload)
 printVerbose(data)
-response = requests.post(args.url, data = data)
+try:
+    response = requests.post(args.url, data = data, timeout = args.timeout)
+except requests.exceptions.RequestException:
+    printVerbose(sys.exc_info())
+    print("ERROR - Error al enviar la notificación a Rocket.Chat")
+    sys.exit(1)
+if response.status_code < 300:
+    dedupSent()
 print(response.text)